@@ -3,9 +3,11 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 import pprint
 
+import os
 import time
+from collections import OrderedDict
 from anki.hooks import runHook
-from anki.utils import intTime, timestampID, joinFields
+from anki.utils import intTime, timestampID, joinFields, checksum, json
 from anki.consts import *
 
 # Cards
@@ -21,12 +23,15 @@ from anki.consts import *
 
 class Card(object):
 
-    def __init__(self, col, id=None):
+    def __init__(self, col, id=None, row=None):
         self.col = col
         self.timerStarted = None
         self._qa = None
         self._note = None
-        if id:
+        if row:
+            # already fetched, as by col.getCards()
+            self._fromRow(row)
+        elif id:
             self.id = id
             self.load()
         else:
@@ -47,6 +52,10 @@ class Card(object):
             self.data = ""
 
     def load(self):
+        self._fromRow(self.col.db.first(
+            "select * from cards where id = ?", self.id))
+
+    def _fromRow(self, row):
         (self.id,
          self.nid,
          self.did,
@@ -64,8 +73,7 @@ class Card(object):
          self.odue,
          self.odid,
          self.flags,
-         self.data) = self.col.db.first(
-             "select * from cards where id = ?", self.id)
+         self.data) = row
         self._qa = None
         self._note = None
 
@@ -134,7 +142,7 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
                 args = (t.get('bqfmt'), t.get('bafmt'))
             else:
                 args = tuple()
-            self._qa = self.col._renderQA(data, *args)
+            self._qa = self.col.qaCache.renderQA(data, f.mod, args, reload)
         return self._qa
 
     def note(self, reload=False):
@@ -183,3 +191,84 @@ lapses=?, left=?, odue=?, odid=?, did=? where id = ?""",
         del d['col']
         del d['timerStarted']
         return pprint.pformat(d, width=300)
+
+# Rendered question/answer cache
+##########################################################################
+
+class QACache(object):
+    """Most recently rendered questions and answers, by card.
+
+An entry is used only while the card's note, model, template and deck name
+are unchanged. Call persist() to keep the cache on disk between sessions."""
+
+    def __init__(self, col, size=1000):
+        self.col = col
+        self.size = size
+        self.path = None
+        self.entries = OrderedDict()
+        # nid -> keys of its cards
+        self.nids = {}
+
+    def renderQA(self, data, mod, args=(), reload=False):
+        "Return col._renderQA(DATA, *ARGS) for a note last modified at MOD."
+        # browser formats are only a separate entry if they're provided
+        key = (data[0], any(args))
+        m = self.col.models.get(data[2])
+        # the checksum catches bulk updates in the same second
+        stamp = [data[1], mod, data[2], m['mod'], data[4],
+                 self.col.decks.name(data[3]), checksum(data[5] + data[6])]
+        entry = self.entries.pop(key, None)
+        if entry and entry[0] == stamp and not reload:
+            self.entries[key] = entry
+            return entry[1]
+        qa = self.col._renderQA(data, *args)
+        self._add(key, stamp, qa)
+        return qa
+
+    def _add(self, key, stamp, qa):
+        self.entries[key] = (stamp, qa)
+        self.nids.setdefault(stamp[0], set()).add(key)
+        while len(self.entries) > self.size:
+            key, (stamp, qa) = self.entries.popitem(last=False)
+            self._forget(stamp[0], key)
+
+    def _forget(self, nid, key):
+        keys = self.nids.get(nid)
+        if keys:
+            keys.discard(key)
+            if not keys:
+                del self.nids[nid]
+
+    def invalidate(self, nids=None):
+        "Forget cards of NIDS, or all cards if not provided."
+        if nids is None:
+            self.entries.clear()
+            self.nids.clear()
+            return
+        for nid in nids:
+            for key in self.nids.pop(nid, ()):
+                self.entries.pop(key, None)
+
+    # On-disk persistence
+    ######################################################################
+
+    def persist(self, path):
+        "Load entries saved at PATH, and save them there on flush()."
+        self.path = path
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except ValueError:
+            # damaged; start again
+            return
+        for key, stamp, qa in entries:
+            self._add(tuple(key), stamp, qa)
+
+    def flush(self):
+        if not self.path:
+            return
+        with open(self.path, "w") as f:
+            json.dump([(key, stamp, qa) for key, (stamp, qa)
+                       in self.entries.items()], f)
@@ -14,13 +14,14 @@ import traceback
 
 from anki.lang import _, ngettext
 from anki.utils import ids2str, fieldChecksum, stripHTML, \
-    intTime, splitFields, joinFields, maxID, json
+    intTime, splitFields, joinFields, maxID, json, stripHTMLMedia
 from anki.hooks import  runFilter, runHook
 from anki.sched import Scheduler
 from anki.models import ModelManager
 from anki.media import MediaManager
 from anki.decks import DeckManager
 from anki.tags import TagManager
+from anki.fts import TextIndex
 from anki.consts import *
 from anki.errors import AnkiError
 from anki.sound import stripSounds
@@ -54,6 +55,7 @@ class _Collection(object):
     def __init__(self, db, server=False, log=False):
         self._debugLog = log
         self.db = db
+        anki.find.registerFunctions(db)
         self.path = db._path
         self._openLog()
         self.log(self.path, anki.version)
@@ -64,7 +66,11 @@ class _Collection(object):
         self.models = ModelManager(self)
         self.decks = DeckManager(self)
         self.tags = TagManager(self)
+        self.fts = TextIndex(self)
+        self._findCache = anki.find.QueryCache()
+        self.qaCache = anki.cards.QACache(self)
         self.load()
+        self.tags.openIndex()
         if not self.crt:
             d = datetime.datetime.today()
             d -= datetime.timedelta(hours=4)
@@ -101,6 +107,8 @@ conf, models, decks, dconf, tags from col""")
         self.models.load(models)
         self.decks.load(decks, dconf)
         self.tags.load(tags)
+        self.tags.loadIndex()
+        self.fts.load()
 
     def setMod(self):
         """Mark DB modified.
@@ -117,6 +125,8 @@ is only necessary if you modify properties of this object or the conf dict."""
 crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             self.crt, self.mod, self.scm, self.dty,
             self._usn, self.ls, json.dumps(self.conf))
+        self.tags.stampIndex()
+        self.fts.stamp()
 
     def save(self, name=None, mod=None):
         "Flush, commit DB, and take out another write lock."
@@ -156,6 +166,7 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             self.db.close()
             self.db = None
             self.media.close()
+            self.qaCache.flush()
             self._closeLog()
 
     def reopen(self):
@@ -163,6 +174,7 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         import anki.db
         if not self.db:
             self.db = anki.db.DB(self.path)
+            anki.find.registerFunctions(self.db)
             self.media.connect()
             self._openLog()
 
@@ -197,6 +209,7 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         self.models.beforeUpload()
         self.tags.beforeUpload()
         self.decks.beforeUpload()
+        self.fts.beforeUpload()
         self.modSchema()
         self.ls = self.scm
         # ensure db is compacted before upload
@@ -213,14 +226,42 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
     def getNote(self, id):
         return anki.notes.Note(self, id=id)
 
+    def getCards(self, ids, notes=False, chunk=1000):
+        """Return cards for IDS in the same order, fetching CHUNK per query.
+        Missing cards are skipped. If NOTES is true, their notes are loaded
+        too, so card.note() doesn't need a query per card."""
+        cards = {}
+        for i in range(0, len(ids), chunk):
+            for row in self.db.all(
+                "select * from cards where id in " + ids2str(ids[i:i+chunk])):
+                cards[row[0]] = anki.cards.Card(self, row=row)
+        if notes:
+            nids = list(set(c.nid for c in cards.values()))
+            nmap = dict((n.id, n) for n in self.getNotes(nids, chunk))
+            for c in cards.values():
+                c._note = nmap[c.nid]
+        return [cards[id] for id in ids if id in cards]
+
+    def getNotes(self, ids, chunk=1000):
+        """Return notes for IDS in the same order, fetching CHUNK per query.
+        Missing notes are skipped."""
+        notes = {}
+        for i in range(0, len(ids), chunk):
+            for row in self.db.all("""
+select id, guid, mid, mod, usn, tags, flds, flags, data from notes
+where id in """ + ids2str(ids[i:i+chunk])):
+                notes[row[0]] = anki.notes.Note(self, row=row)
+        return [notes[id] for id in ids if id in notes]
+
     # Utils
     ##########################################################################
 
     def nextID(self, type, inc=True):
+        "Return the next TYPE id, and reserve INC of them if it's a number."
         type = "next"+type.capitalize()
         id = self.conf.get(type, 1)
         if inc:
-            self.conf[type] = id+1
+            self.conf[type] = id+inc
         return id
 
     def reset(self):
@@ -260,6 +301,69 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             ncards += 1
         return ncards
 
+    def addNotes(self, notes):
+        """Add NOTES in bulk, like addNote(). Notes that wouldn't have any cards
+        are skipped. The others are given new ids, which are returned."""
+        # find the cards each note needs; most notes share a few models and
+        # tag lists, so work those out once
+        added = []
+        tmpls = {}
+        for note in notes:
+            assert note.scm == self.scm
+            flds = note.joinedFields()
+            model = note.model()
+            ords = tuple(self.models.availOrds(model, flds))
+            key = (model['id'], ords)
+            if key not in tmpls:
+                tmpls[key] = self._tmplsFromOrds(model, ords)
+            if tmpls[key]:
+                added.append((note, model, flds, tmpls[key]))
+        if not added:
+            return []
+        # allocate ids and positions
+        nid = cid = maxID(self.db)
+        due = self.nextID("pos", len(added))
+        now = intTime()
+        usn = self.usn()
+        notes = []
+        cards = []
+        tags = {}
+        dids = {}
+        inOrder = {}
+        for note, model, flds, cms in added:
+            note.id = nid
+            note.mod = now
+            note.usn = usn
+            key = tuple(note.tags)
+            if key not in tags:
+                tags[key] = note.stringTags()
+            sfld = stripHTMLMedia(note.fields[model['sortf']])
+            notes.append((nid, note.guid, note.mid, now, usn, tags[key],
+                          flds, sfld, fieldChecksum(note.fields[0]),
+                          note.flags, note.data))
+            for t in cms:
+                did = self._genDeck(t['did'], model['did'], dids)
+                if did not in inOrder:
+                    conf = self.decks.confForDid(did)
+                    inOrder[did] = conf['new']['order'] == NEW_CARDS_DUE
+                if inOrder[did]:
+                    cdue = due
+                else:
+                    cdue = self._dueForDid(did, due)
+                cards.append((cid, nid, did, t['ord'], now, usn, cdue))
+                cid += 1
+            nid += 1
+            due += 1
+        self.db.executemany("""
+insert into notes values (?,?,?,?,?,?,?,?,?,?,?)""", notes)
+        self.db.executemany("""
+insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""", cards)
+        nids = [n[0] for n in notes]
+        self.tags.register(set(t for k in tags for t in k))
+        self.tags.updateIndex(nids)
+        self.fts.update(nids)
+        return nids
+
     def remNotes(self, ids):
         self.remCards(self.db.list("select id from cards where nid in "+
                                    ids2str(ids)))
@@ -274,6 +378,9 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
         runHook("remNotes", self, ids)
         self._logRem(ids, REM_NOTE)
         self.db.execute("delete from notes where id in %s" % strids)
+        self.tags.removeIndex(ids)
+        self.fts.remove(ids)
+        self.qaCache.invalidate(ids)
 
     # Card creation
     ##########################################################################
@@ -298,8 +405,17 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
                 ok.append(t)
         return ok
 
-    def genCards(self, nids):
+    def genCards(self, nids, chunk=1000):
         "Generate cards for non-empty templates, return ids to remove."
+        nids = list(nids)
+        state = dict(ts=maxID(self.db), now=intTime(), usn=self.usn(),
+                     dids={})
+        rem = []
+        for i in range(0, len(nids), chunk):
+            rem += self._genCards(nids[i:i+chunk], state)
+        return rem
+
+    def _genCards(self, nids, state):
         # build map of (nid,ord) so we don't create dupes
         snids = ids2str(nids)
         have = {}
@@ -321,10 +437,8 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
                 dids[nid] = did
         # build cards for each note
         data = []
-        ts = maxID(self.db)
-        now = intTime()
+        ts = state['ts']
         rem = []
-        usn = self.usn()
         for nid, mid, flds in self.db.execute(
             "select id, mid, flds from notes where id in "+snids):
             model = self.models.get(mid)
@@ -334,29 +448,41 @@ crt=?, mod=?, scm=?, dty=?, usn=?, ls=?, conf=?""",
             for t in self._tmplsFromOrds(model, avail):
                 doHave = nid in have and t['ord'] in have[nid]
                 if not doHave:
-                    # check deck is not a cram deck
-                    did = t['did'] or did
-                    if self.decks.isDyn(did):
-                        did = 1
-                    # if the deck doesn't exist, use default instead
-                    did = self.decks.get(did)['id']
-                    # we'd like to use the same due# as sibling cards, but we
-                    # can't retrieve that quickly, so we give it a new id
-                    # instead
-                    data.append((ts, nid, did, t['ord'],
-                                 now, usn, self.nextID("pos")))
+                    did = self._genDeck(t['did'], did, state['dids'])
+                    data.append((ts, nid, did, t['ord']))
                     ts += 1
             # note any cards that need removing
             if nid in have:
                 for ord, id in have[nid].items():
                     if ord not in avail:
                         rem.append(id)
-        # bulk update
+        state['ts'] = ts
+        if not data:
+            return rem
+        # we'd like to use the same due# as sibling cards, but we can't
+        # retrieve that quickly, so each card gets a new position, all
+        # reserved in one step
+        pos = self.nextID("pos", len(data))
+        now = state['now']
+        usn = state['usn']
         self.db.executemany("""
 insert into cards values (?,?,?,?,?,?,0,0,?,0,0,0,0,0,0,0,0,"")""",
-                            data)
+            [(id, nid, did, ord, now, usn, pos + c)
+             for c, (id, nid, did, ord) in enumerate(data)])
         return rem
 
+    def _genDeck(self, tdid, did, cache):
+        "Deck for a new card with template deck TDID and note deck DID."
+        key = (tdid, did)
+        if key not in cache:
+            new = tdid or did
+            # check deck is not a cram deck
+            if self.decks.isDyn(new):
+                new = 1
+            # if the deck doesn't exist, use default instead
+            cache[key] = self.decks.get(new)['id']
+        return cache[key]
+
     # type 0 - when previewing in add dialog, only non-empty
     # type 1 - when previewing edit, only existing
     # type 2 - when previewing in models dialog, all templates
@@ -467,24 +593,42 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
                       nid))
         # apply, relying on calling code to bump usn+mod
         self.db.executemany("update notes set sfld=?, csum=? where id=?", r)
+        self.tags.updateIndex(nids)
+        self.fts.update(nids)
 
     # Q/A generation
     ##########################################################################
 
     def renderQA(self, ids=None, type="card"):
-        # gather metadata
+        return list(self.iterRenderQA(ids, type))
+
+    def iterRenderQA(self, ids=None, type="card", chunk=1000):
+        "Yield renderQA() results in card id order, reading CHUNK at a time."
         if type == "card":
-            where = "and c.id in " + ids2str(ids)
-        elif type == "note":
+            ids = sorted(ids)
+            for i in range(0, len(ids), chunk):
+                for row in self._qaData(
+                    "and c.id in %s order by c.id" % ids2str(ids[i:i+chunk])):
+                    yield self._renderQA(row)
+            return
+        # gather metadata
+        if type == "note":
             where = "and f.id in " + ids2str(ids)
         elif type == "model":
-            where = "and m.id in " + ids2str(ids)
+            where = "and f.mid in " + ids2str(ids)
         elif type == "all":
             where = ""
         else:
             raise Exception()
-        return [self._renderQA(row)
-                for row in self._qaData(where)]
+        lastId = 0
+        while 1:
+            rows = self._qaData("%s and c.id > %d order by c.id limit %d" % (
+                where, lastId, chunk))
+            if not rows:
+                break
+            for row in rows:
+                yield self._renderQA(row)
+            lastId = rows[-1][0]
 
     def _renderQA(self, data, qfmt=None, afmt=None):
         "Returns hash of id, question, answer."
@@ -506,22 +650,16 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
         fields['c%d' % (data[4]+1)] = "1"
         # render q & a
         d = dict(id=data[0])
-        qfmt = qfmt or template['qfmt']
-        afmt = afmt or template['afmt']
-        for (type, format) in (("q", qfmt), ("a", afmt)):
-            if type == "q":
-                format = format.replace("{{cloze:", "{{cq:%d:" % (
-                    data[4]+1))
-                format = format.replace("<%cloze:", "<%%cq:%d:" % (
-                    data[4]+1))
-            else:
-                format = format.replace("{{cloze:", "{{ca:%d:" % (
-                    data[4]+1))
-                format = format.replace("<%cloze:", "<%%ca:%d:" % (
-                    data[4]+1))
+        # custom browser formats are cached separately
+        formats = (("q", qfmt and "bq", qfmt or template['qfmt']),
+                   ("a", afmt and "ba", afmt or template['afmt']))
+        for (type, key, format) in formats:
+            format = self._clozeFormat(format, type, data[4])
+            if type == "a":
                 fields['FrontSide'] = stripSounds(d['q'])
             fields = runFilter("mungeFields", fields, model, data, self)
-            html = anki.template.render(format, fields)
+            html = self.models.compiledTemplate(
+                model, data[4], key or type, format).render(fields)
             d[type] = runFilter(
                 "mungeQA", html, type, fields, model, data, self)
             # empty cloze?
@@ -532,10 +670,19 @@ where c.nid = n.id and c.id in %s group by nid""" % ids2str(cids)):
                 "<a href=%s#cloze>%s</a>" % (HELP_SITE, _("help"))))
         return d
 
+    def _clozeFormat(self, format, type, ord):
+        "Point cloze tags in FORMAT at card ORD's TYPE side."
+        if "cloze:" not in format:
+            return format
+        format = format.replace("{{cloze:", "{{c%s:%d:" % (type, ord+1))
+        return format.replace("<%cloze:", "<%%c%s:%d:" % (type, ord+1))
+
     def _qaData(self, where=""):
-        "Return [cid, nid, mid, did, ord, tags, flds] db query"
-        return self.db.execute("""
-select c.id, f.id, f.mid, c.did, c.ord, f.tags, f.flds
+        "Return [cid, nid, mid, did, ord, tags, flds] rows"
+        # like Card, this uses the home deck of cards in a filtered deck
+        return self.db.all("""
+select c.id, f.id, f.mid, (case when c.odid then c.odid else c.did end),
+c.ord, f.tags, f.flds
 from cards c, notes f
 where c.nid == f.id
 %s""" % where)
@@ -543,18 +690,35 @@ where c.nid == f.id
     # Finding cards
     ##########################################################################
 
-    def findCards(self, query, order=False):
-        return anki.find.Finder(self).findCards(query, order)
+    def findCards(self, query, order=False, limit=None):
+        return anki.find.Finder(self).findCards(query, order, limit)
 
     def findNotes(self, query):
         return anki.find.Finder(self).findNotes(query)
 
-    def findReplace(self, nids, src, dst, regex=None, field=None, fold=True):
-        return anki.find.findReplace(self, nids, src, dst, regex, field, fold)
+    def findCardsPage(self, query, order=False, limit=100, after=None):
+        return anki.find.Finder(self).findCardsPage(query, order, limit, after)
+
+    def iterCards(self, query, order=False, chunk=1000):
+        return anki.find.Finder(self).iterCards(query, order, chunk)
+
+    def iterNotes(self, query, chunk=1000):
+        return anki.find.Finder(self).iterNotes(query, chunk)
+
+    def countCards(self, query):
+        return anki.find.Finder(self).countCards(query)
+
+    def findReplace(self, nids, src, dst, regex=None, field=None, fold=True,
+                    progress=None):
+        return anki.find.findReplace(self, nids, src, dst, regex, field, fold,
+                                     progress)
 
     def findDupes(self, fieldName, search=""):
         return anki.find.findDupes(self, fieldName, search)
 
+    def iterDupes(self, fieldName, search=""):
+        return anki.find.iterDupes(self, fieldName, search)
+
     # Stats
     ##########################################################################
 
@@ -750,6 +914,7 @@ select id from cards where odue > 0 and (type=1 or queue=2) and not odid""")
                 ids2str(ids))
         # tags
         self.tags.registerNotes()
+        self.tags.rebuildIndex()
         # field cache
         for m in self.models.all():
             self.updateFieldCache(self.models.nids(m))
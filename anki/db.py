@@ -23,6 +23,7 @@ class DB(object):
         self._path = path
         self.echo = os.environ.get("DBECHO")
         self.mod = False
+        self.progressHandler = None
 
     def execute(self, sql, *a, **ka):
         s = sql.strip().lower()
@@ -91,6 +92,11 @@ class DB(object):
 
     def set_progress_handler(self, *args):
         self._db.set_progress_handler(*args)
+        # so it can be restored after being replaced temporarily
+        self.progressHandler = args
+
+    def create_function(self, *args):
+        self._db.create_function(*args)
 
     def __enter__(self):
         self._db.execute("begin")
@@ -89,17 +89,24 @@ class DeckManager(object):
 
     def __init__(self, col):
         self.col = col
+        self._names = None
 
     def load(self, decks, dconf):
         self.decks = json.loads(decks)
         self.dconf = json.loads(dconf)
         self.changed = False
+        self._names = None
 
     def save(self, g=None):
         "Can be called with either a deck or a deck configuration."
         if g:
             g['mod'] = intTime()
             g['usn'] = self.col.usn()
+            # a deck renamed behind our back?
+            if (self._names is not None and
+                self.decks.get(str(g['id'])) is g and
+                self._names.get(g['name'].lower()) != int(g['id'])):
+                self._names = None
         self.changed = True
 
     def flush(self):
@@ -115,9 +122,9 @@ class DeckManager(object):
     def id(self, name, create=True, type=defaultDeck):
         "Add a deck with NAME. Reuse deck if already exists. Return id as int."
         name = name.replace('"', '')
-        for id, g in self.decks.items():
-            if g['name'].lower() == name.lower():
-                return int(id)
+        id = self._index()[0].get(name.lower())
+        if id is not None:
+            return id
         if not create:
             return None
         g = copy.deepcopy(type)
@@ -131,6 +138,7 @@ class DeckManager(object):
                 break
         g['id'] = id
         self.decks[str(id)] = g
+        self._addToIndex(g)
         self.save(g)
         self.maybeAddToActive()
         runHook("newDeck")
@@ -173,6 +181,7 @@ class DeckManager(object):
                 self.col.remCards(cids)
         # delete the deck and add a grave
         del self.decks[str(did)]
+        self._names = None
         # ensure we have an active deck
         if did in self.active():
             self.select(int(self.decks.keys()[0]))
@@ -209,6 +218,12 @@ class DeckManager(object):
 
     def byName(self, name):
         "Get deck with NAME."
+        id = self._index()[0].get(name.lower())
+        if id is not None:
+            m = self.decks[str(id)]
+            if m['name'] == name:
+                return m
+        # another deck differing only in case may have shadowed it
         for m in self.decks.values():
             if m['name'] == name:
                 return m
@@ -216,6 +231,7 @@ class DeckManager(object):
     def update(self, g):
         "Add or update an existing deck. Used for syncing and merging."
         self.decks[str(g['id'])] = g
+        self._names = None
         self.maybeAddToActive()
         # mark registry changed, but don't bump mod time
         self.save()
@@ -235,6 +251,7 @@ class DeckManager(object):
                 self.save(grp)
         # adjust name
         g['name'] = newName
+        self._names = None
         # ensure we have parents again, as we may have renamed parent->child
         newName = self._ensureParents(newName)
         self.save(g)
@@ -378,9 +395,11 @@ class DeckManager(object):
         return None
 
     def setDeck(self, cids, did):
+        cache = self.col.sched._uncacheCards(cids)
         self.col.db.execute(
             "update cards set did=?,usn=?,mod=? where id in "+
             ids2str(cids), did, self.col.usn(), intTime())
+        self.col.sched._recacheCards(cids, cache)
 
     def maybeAddToActive(self):
         # reselect current deck, or default if current has disappeared
@@ -433,9 +452,8 @@ class DeckManager(object):
         "All children of did, as (name, id)."
         name = self.get(did)['name']
         actv = []
-        for g in self.all():
-            if g['name'].startswith(name + "::"):
-                actv.append((g['name'], g['id']))
+        for id in self._index()[1].get(name, []):
+            actv.append((self.decks[str(id)]['name'], id))
         return actv
 
     def parents(self, did):
@@ -452,6 +470,29 @@ class DeckManager(object):
             parents[c] = self.get(self.id(p))
         return parents
 
+    # Name index
+    ##########################################################################
+    # maps lowercase name -> id, and each path prefix -> ids of all decks
+    # below it. rebuilt lazily after loads, renames and removals.
+
+    def _index(self):
+        if self._names is None:
+            self._names = {}
+            self._descendants = {}
+            for g in self.decks.values():
+                self._addToIndex(g)
+        return self._names, self._descendants
+
+    def _addToIndex(self, g):
+        if self._names is None:
+            # will be picked up on next rebuild
+            return
+        self._names[g['name'].lower()] = int(g['id'])
+        path = self._path(g['name'])
+        for i in range(1, len(path)):
+            self._descendants.setdefault(
+                "::".join(path[:i]), []).append(int(g['id']))
+
     # Sync handling
     ##########################################################################
 
@@ -47,18 +47,14 @@ class TextCardExporter(Exporter):
         Exporter.__init__(self, col)
 
     def doExport(self, file):
-        ids = sorted(self.cardIds())
-        strids = ids2str(ids)
+        ids = self.cardIds()
         def esc(s):
             # strip off the repeated question in answer if exists
             s = re.sub("(?si)^.*<hr id=answer>\n*", "", s)
             return self.escapeText(s)
-        out = ""
-        for cid in ids:
-            c = self.col.getCard(cid)
-            out += esc(c.q())
-            out += "\t" + esc(c.a()) + "\n"
-        file.write(out.encode("utf-8"))
+        for qa in self.col.iterRenderQA(ids):
+            out = esc(qa['q']) + "\t" + esc(qa['a']) + "\n"
+            file.write(out.encode("utf-8"))
 
 # Notes as TSV
 ######################################################################
@@ -3,11 +3,16 @@
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
 import re
+import time
 import sre_constants
+import threading
+from collections import OrderedDict
 
-from anki.utils import ids2str, splitFields, joinFields, intTime, fieldChecksum, stripHTMLMedia
+from anki.utils import ids2str, splitFields, joinFields, intTime, \
+    fieldChecksum, stripHTMLMedia, checksum
 from anki.consts import *
 from anki.hooks import *
+from anki.errors import AnkiError
 
 
 # Find
@@ -15,6 +20,9 @@ from anki.hooks import *
 
 class Finder(object):
 
+    # seconds a regex search may run before it's interrupted
+    regexTimeout = 10
+
     def __init__(self, col):
         self.col = col
         self.search = dict(
@@ -29,43 +37,128 @@ class Finder(object):
             rated=self._findRated,
             tag=self._findTag,
             dupe=self._findDupes,
+            re=self._findRegex,
         )
         self.search['is'] = self._findCardState
+        builtin = self.search.copy()
         runHook("search", self.search)
+        # commands that don't read the notes table while building their SQL.
+        # searches using others are only reused until the DB is modified
+        self._static = set(
+            k for k, v in builtin.items()
+            if k != "dupe" and self.search.get(k) == v)
 
-    def findCards(self, query, order=False):
+    def findCards(self, query, order=False, limit=None):
         "Return a list of card ids for QUERY."
-        tokens = self._tokenize(query)
-        preds, args = self._where(tokens)
-        if preds is None:
-            return []
-        order, rev = self._order(order)
-        sql = self._query(preds, order)
-        try:
-            res = self.col.db.list(sql, *args)
-        except:
-            # invalid grouping
-            return []
-        if rev:
-            res.reverse()
-        return res
+        return self.compile(query).findCards(order, limit)
 
     def findNotes(self, query):
+        return self.compile(query).findNotes()
+
+    def findCardsPage(self, query, order=False, limit=100, after=None):
+        return self.compile(query).findCardsPage(order, limit, after)
+
+    def iterCards(self, query, order=False, chunk=1000):
+        return self.compile(query).iterCards(order, chunk)
+
+    def iterNotes(self, query, chunk=1000):
+        return self.compile(query).iterNotes(chunk)
+
+    def countCards(self, query):
+        return self.compile(query).countCards()
+
+    def compile(self, query):
+        "Return a CompiledQuery for QUERY, reusing a cached one if possible."
+        cache = self.col._findCache
+        q = cache.get(query)
+        if q and q.state == self._state(q.volatile):
+            return q
+        self._volatile = False
+        self._regex = False
         tokens = self._tokenize(query)
         preds, args = self._where(tokens)
+        q = CompiledQuery(self, preds, args, self._volatile, self._regex)
+        q.state = self._state(q.volatile)
+        cache.put(query, q)
+        return q
+
+    def _state(self, volatile):
+        "Everything a search's SQL may depend on, apart from the query."
+        decks = self.col.decks
+        state = (self.col.models._gen, decks._index()[0], len(decks.decks),
+                 self.col.conf['curDeck'], self.col.sched.today,
+                 self.col.sched.dayCutoff, self.col.tags.indexed(),
+                 self.col.fts.enabled())
+        if volatile:
+            state += (self.col.db, self.col.db.totalChanges())
+        return state
+
+    # Profiling
+    ######################################################################
+
+    def profile(self, query, order=False):
+        """Build and run QUERY without the cache, and return a dict describing
+        it: the SQL and args, SQLite's query plan, seconds spent in each phase
+        and each search term, the number of cards found, fieldmatch() calls
+        made, and the number of instructions SQLite executed."""
+        db = self.col.db
+        times = {}
+        terms = []
+        res = dict(query=query, sql=None, args=[], plan=[], times=times,
+                   terms=terms, cards=0, fieldCalls=0, steps=0)
+        def timed(fn, label):
+            def wrapper(*a):
+                t = time.time()
+                try:
+                    return fn(*a)
+                finally:
+                    terms.append((label(*a), time.time() - t))
+            return wrapper
+        search = self.search
+        self.search = dict(
+            (k, timed(fn, lambda (val, args), k=k: k+":"+val))
+            for k, fn in search.items())
+        self._findField = timed(
+            self._findField, lambda field, val, args: field+":"+val)
+        self._findText = timed(self._findText, lambda val, args: val)
+        self._volatile = self._regex = False
+        try:
+            t = time.time()
+            tokens = self._tokenize(query)
+            times['tokenize'] = time.time() - t
+            t = time.time()
+            preds, args = self._where(tokens)
+            times['build'] = time.time() - t
+        finally:
+            self.search = search
+            del self._findField, self._findText
         if preds is None:
-            return []
-        if preds:
-            preds = "(" + preds + ")"
-        else:
-            preds = "1"
-        sql = """
-select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
+            # invalid search
+            return res
+        q = CompiledQuery(self, preds, args, self._volatile, self._regex)
+        sql = self._query(preds, self._order(order))
+        res['sql'] = sql
+        res['args'] = args
+        res['plan'] = [r[-1] for r in db.all("explain query plan "+sql, *args)]
+        t = time.time()
+        res['cards'] = len(q._run(db.list, sql, args, []))
+        times['run'] = time.time() - t
+        # then again, counting the work done, which would distort the time
+        steps = [0]
+        def step():
+            steps[0] += 1
+        old = db.progressHandler
+        db.set_progress_handler(step, 1)
+        _limit.calls = 0
         try:
-            res = self.col.db.list(sql, *args)
-        except:
-            # invalid grouping
-            return []
+            q._run(db.list, sql, args, [])
+        finally:
+            if old:
+                db.set_progress_handler(*old)
+            else:
+                db.set_progress_handler(None, 0)
+        res['fieldCalls'] = _limit.calls
+        res['steps'] = steps[0]
         return res
 
     # Tokenizing
@@ -173,9 +266,11 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                 cmd, val = token.split(":", 1)
                 cmd = cmd.lower()
                 if cmd in self.search:
+                    if cmd not in self._static:
+                        self._volatile = True
                     add(self.search[cmd]((val, args)))
                 else:
-                    add(self._findField(cmd, val))
+                    add(self._findField(cmd, val, args))
             # normal text search
             else:
                 add(self._findText(token, args))
@@ -183,12 +278,12 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
             return None, None
         return s['q'], args
 
-    def _query(self, preds, order):
+    def _query(self, preds, order, cols="c.id"):
         # can we skip the note table?
-        if "n." not in preds and "n." not in order:
-            sql = "select c.id from cards c where "
+        if "n." not in preds and "n." not in order + cols:
+            sql = "select %s from cards c where " % cols
         else:
-            sql = "select c.id from cards c, notes n where c.nid=n.id and "
+            sql = "select %s from cards c, notes n where c.nid=n.id and " % cols
         # combine with preds
         if preds:
             sql += "(" + preds + ")"
@@ -203,43 +298,74 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
     ######################################################################
 
     def _order(self, order):
+        "Return an order clause for ORDER."
         if not order:
-            return "", False
-        elif order is not True:
+            return ""
+        keys = self._sortKeys(order)
+        if keys is None:
             # custom order string provided
-            return " order by " + order, False
+            return " order by " + order
+        return self._orderBy(keys)
+
+    def _orderBy(self, keys):
+        return " order by " + ", ".join(
+            e + (" desc" if desc else "") for e, desc in keys)
+
+    def _sortKeys(self, order):
+        """Return [(expr, desc), ...] giving each card a unique position in
+        ORDER, or None if ORDER is a custom order string."""
+        if not order:
+            return [("c.id", False)]
+        elif order is not True:
+            return None
         # use deck default
         type = self.col.conf['sortType']
         sort = None
         if type.startswith("note"):
             if type == "noteCrt":
-                sort = "n.id, c.ord"
+                sort = ["n.id", "c.ord"]
             elif type == "noteMod":
-                sort = "n.mod, c.ord"
+                sort = ["n.mod", "c.ord"]
             elif type == "noteFld":
-                sort = "n.sfld collate nocase, c.ord"
+                sort = ["n.sfld collate nocase", "c.ord"]
         elif type.startswith("card"):
             if type == "cardMod":
-                sort = "c.mod"
+                sort = ["c.mod"]
             elif type == "cardReps":
-                sort = "c.reps"
+                sort = ["c.reps"]
             elif type == "cardDue":
-                sort = "c.type, c.due"
+                sort = ["c.type", "c.due"]
             elif type == "cardEase":
-                sort = "c.factor"
+                sort = ["c.factor"]
             elif type == "cardLapses":
-                sort = "c.lapses"
+                sort = ["c.lapses"]
             elif type == "cardIvl":
-                sort = "c.ivl"
+                sort = ["c.ivl"]
         if not sort:
             # deck has invalid sort order; revert to noteCrt
-            sort = "n.id, c.ord"
-        return " order by " + sort, self.col.conf['sortBackwards']
+            sort = ["n.id", "c.ord"]
+        # ties are broken by card id, so pages don't overlap
+        desc = bool(self.col.conf['sortBackwards'])
+        return [(e, desc) for e in sort + ["c.id"]]
+
+    def _after(self, keys, vals):
+        "Return SQL and args matching cards after VALS in order KEYS."
+        terms = []
+        args = []
+        for i, (expr, desc) in enumerate(keys):
+            eq = ["%s = ?" % e for e, d in keys[:i]]
+            terms.append("(%s)" % " and ".join(
+                eq + ["%s %s ?" % (expr, "<" if desc else ">")]))
+            args.extend(vals[:i+1])
+        return "(" + " or ".join(terms) + ")", args
 
     # Commands
     ######################################################################
 
     def _findTag(self, (val, args)):
+        sql = self.col.tags.search(val, args)
+        if sql:
+            return sql
         if val == "none":
             return 'n.tags = ""'
         val = val.replace("*", "%")
@@ -327,6 +453,9 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
 
     def _findText(self, val, args):
         val = val.replace("*", "%")
+        sql = self.col.fts.search(val, args)
+        if sql:
+            return sql
         args.append("%"+val+"%")
         args.append("%"+val+"%")
         return "(n.sfld like ? escape '\\' or n.flds like ? escape '\\')"
@@ -409,9 +538,8 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
                             m['id'], t['ord']))
         return " or ".join(lims)
 
-    def _findField(self, field, val):
+    def _findField(self, field, val, args):
         field = field.lower()
-        val = val.replace("*", "%")
         # find models that have that field
         mods = {}
         for m in self.col.models.all():
@@ -421,25 +549,50 @@ select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
         if not mods:
             # nothing has that field
             return
-        # gather nids
-        regex = re.escape(val).replace("\\_", ".").replace("\\%", ".*")
-        nids = []
-        for (id,mid,flds) in self.col.db.execute("""
-select id, mid, flds from notes
-where mid in %s and flds like ? escape '\\'""" % (
-                         ids2str(mods.keys())),
-                         "%"+val+"%"):
-            flds = splitFields(flds)
-            ord = mods[str(mid)][1]
-            strg = flds[ord]
+        if val.startswith("re:"):
+            regex = self._regexFor(val[3:])
+            if not regex:
+                return
+            sql = ""
+        else:
+            val = val.replace("*", "%")
+            regex = re.escape(val).replace("\\_", ".").replace("\\%", ".*")
+            regex = "(?i)^"+regex+"$"
             try:
-                if re.search("(?i)^"+regex+"$", strg):
-                    nids.append(id)
+                re.compile(regex)
             except sre_constants.error:
                 return
-        if not nids:
-            return "0"
-        return "n.id in %s" % ids2str(nids)
+            # the like narrows the notes down before the field is extracted
+            args.append("%"+val+"%")
+            sql = "n.flds like ? escape '\\' and "
+        lims = []
+        for mid, (m, ord) in mods.items():
+            lims.append("(n.mid = %s and fieldmatch(n.flds, %d, ?))" % (
+                mid, ord))
+            args.append(regex)
+        return sql + "(%s)" % " or ".join(lims)
+
+    def _findRegex(self, (val, args)):
+        regex = self._regexFor(val)
+        if not regex:
+            return
+        args.append(regex)
+        return "fieldmatch(n.flds, -1, ?)"
+
+    def _regexFor(self, val):
+        "Return a case insensitive regex for VAL, or None if it's unusable."
+        # patterns like (a|a)* or .*.*x can take exponential or high
+        # polynomial time, and can't be interrupted while they're matching
+        # a single field
+        if _slowRegex(val):
+            return
+        regex = "(?iu)" + val
+        try:
+            re.compile(regex)
+        except sre_constants.error:
+            return
+        self._regex = True
+        return regex
 
     def _findDupes(self, (val, args)):
         # caller must call stripHTMLMedia on passed val
@@ -452,15 +605,263 @@ where mid in %s and flds like ? escape '\\'""" % (
         for nid, flds in self.col.db.execute(
                 "select id, flds from notes where mid=? and csum=?",
                 mid, csum):
-            if stripHTMLMedia(splitFields(flds)[0]) == val:
+            if _dupeValue(splitFields(flds)[0]) == val:
                 nids.append(nid)
         return "n.id in %s" % ids2str(nids)
 
+# Compiled queries
+##########################################################################
+
+class CompiledQuery(object):
+    "A parsed search, which can be run repeatedly with different orders."
+
+    def __init__(self, finder, preds, args, volatile, regex=False):
+        self.finder = finder
+        # None if the search was invalid
+        self.preds = preds
+        self.args = args
+        self.volatile = volatile
+        self.regex = regex
+        self.state = None
+
+    def _run(self, fn, sql, args, default):
+        """Return FN(SQL, *ARGS), or DEFAULT if the SQL was invalid. Regex
+        searches are interrupted if they take too long."""
+        if self.regex:
+            _limit.deadline = time.time() + self.finder.regexTimeout
+            _limit.db = self.finder.col.db
+            _limit.expired = False
+        try:
+            res = fn(sql, *args)
+        except:
+            if self.regex and _limit.expired:
+                raise AnkiError("searchTimeout")
+            # invalid grouping
+            return default
+        else:
+            # the last match may have run past the deadline
+            if self.regex and _limit.expired:
+                raise AnkiError("searchTimeout")
+            return res
+        finally:
+            _limit.deadline = _limit.db = None
+
+    def findCards(self, order=False, limit=None):
+        "Return a list of card ids, in ORDER if provided, up to LIMIT."
+        if self.preds is None:
+            return []
+        sql = self.finder._query(self.preds, self.finder._order(order))
+        if limit is not None:
+            sql += " limit %d" % limit
+        return self._run(self.finder.col.db.list, sql, self.args, [])
+
+    def findCardsPage(self, order=False, limit=100, after=None):
+        """Return (ids, cursor) for up to LIMIT cards in ORDER. AFTER is None
+        for the first page, and the previous page's cursor for later ones.
+        The cursor is None after the last page."""
+        if self.preds is None:
+            return [], None
+        keys = self.finder._sortKeys(order)
+        preds = self.preds
+        args = self.args
+        if keys is None:
+            # custom order strings can only be paged by offset
+            offset = after or 0
+            sql = self.finder._query(preds, self.finder._order(order))
+            sql += " limit %d offset %d" % (limit, offset)
+        else:
+            if after is not None:
+                extra, extraArgs = self.finder._after(keys, after)
+                preds = "(%s) and %s" % (preds or "1", extra)
+                args = args + extraArgs
+            # the last key is the card id
+            sql = self.finder._query(preds, self.finder._orderBy(keys),
+                                     ", ".join(e for e, d in keys))
+            sql += " limit %d" % limit
+        rows = self._run(self.finder.col.db.all, sql, args, [])
+        ids = [r[-1] for r in rows]
+        if len(rows) < limit:
+            return ids, None
+        if keys is None:
+            return ids, offset + len(rows)
+        return ids, tuple(rows[-1])
+
+    def iterCards(self, order=False, chunk=1000):
+        "Yield card ids in ORDER, fetching CHUNK at a time."
+        after = None
+        while 1:
+            ids, after = self.findCardsPage(order, chunk, after)
+            for id in ids:
+                yield id
+            if after is None:
+                return
+
+    def countCards(self):
+        "Return the number of matching cards."
+        if self.preds is None:
+            return 0
+        sql = self.finder._query(self.preds, "", "count()")
+        return self._run(self.finder.col.db.scalar, sql, self.args, 0)
+
+    def findNotes(self):
+        "Return a list of note ids."
+        return self._notes("", [])
+
+    def iterNotes(self, chunk=1000):
+        "Yield note ids in creation order, fetching CHUNK at a time."
+        lastId = 0
+        while 1:
+            ids = self._notes(
+                " and n.id > ? order by n.id limit %d" % chunk, [lastId])
+            for id in ids:
+                yield id
+            if len(ids) < chunk:
+                return
+            lastId = ids[-1]
+
+    def _notes(self, extra, args):
+        if self.preds is None:
+            return []
+        if self.preds:
+            preds = "(" + self.preds + ")"
+        else:
+            preds = "1"
+        sql = """
+select distinct(n.id) from cards c, notes n where c.nid=n.id and """+preds
+        return self._run(
+            self.finder.col.db.list, sql + extra, self.args + args, [])
+
+class QueryCache(object):
+    "Most recently used compiled queries, by search string."
+
+    def __init__(self, size=50):
+        self.size = size
+        self.queries = OrderedDict()
+
+    def get(self, query):
+        q = self.queries.pop(query, None)
+        if q is not None:
+            self.queries[query] = q
+        return q
+
+    def put(self, query, q):
+        self.queries.pop(query, None)
+        self.queries[query] = q
+        while len(self.queries) > self.size:
+            self.queries.popitem(last=False)
+
+    def clear(self):
+        self.queries.clear()
+
+def _slowRegex(regex):
+    """True if matching REGEX could take more than quadratic time: if it
+    repeats a group that contains alternation or a quantifier, like (a|a)*,
+    or has more than one unbounded quantifier, like .*.*x."""
+    # for each open group, whether it contains | or a quantifier so far
+    groups = [False]
+    unbounded = 0
+    i = 0
+    while i < len(regex):
+        c = regex[i]
+        if c == "\\":
+            i += 1
+        elif c == "[":
+            # skip the character class; a ] straight after [ or [^ is literal
+            i += 1
+            if regex[i:i+1] == "^":
+                i += 1
+            if regex[i:i+1] == "]":
+                i += 1
+            while i < len(regex) and regex[i] != "]":
+                if regex[i] == "\\":
+                    i += 1
+                i += 1
+        elif c == "(":
+            groups.append(False)
+            if regex[i+1:i+2] == "?":
+                # (?:, (?i) etc. aren't quantifiers
+                i += 1
+        elif c == ")" and len(groups) > 1:
+            risky = groups.pop()
+            if risky and regex[i+1:i+2] in ("*", "+", "{"):
+                return True
+            groups[-1] = groups[-1] or risky
+        elif c in "|*+?{":
+            groups[-1] = True
+            if c in "*+":
+                unbounded += 1
+            elif c == "{":
+                # {n,} and large bounds cost as much as *
+                m = re.match(r"\{\d*,(\d*)\}", regex[i:])
+                if m and (not m.group(1) or int(m.group(1)) > 100):
+                    unbounded += 1
+        i += 1
+    return unbounded > 1
+
+# SQL functions
+##########################################################################
+
+_fieldRegexes = {}
+
+class _Limit(threading.local):
+    "The time the regex search running in this thread must finish by."
+    deadline = None
+    db = None
+    expired = False
+    # fieldmatch() calls, for profiling
+    calls = 0
+
+_limit = _Limit()
+
+def _fieldMatch(flds, ord, regex):
+    "True if field ORD of FLDS matches REGEX, or any field if ORD is -1."
+    _limit.calls += 1
+    r = _fieldRegexes.get(regex)
+    if r is None:
+        if len(_fieldRegexes) > 100:
+            _fieldRegexes.clear()
+        r = _fieldRegexes[regex] = re.compile(regex)
+    if ord == -1:
+        fields = splitFields(flds)
+    else:
+        try:
+            fields = [splitFields(flds)[ord]]
+        except IndexError:
+            # note has fewer fields than its model
+            return False
+    # checked around each field, as a single match can't be interrupted;
+    # a match that finished late is still reported as a timeout
+    for fld in fields:
+        if _expired():
+            return False
+        if r.search(fld):
+            return not _expired()
+    _expired()
+    return False
+
+def _expired():
+    "True if the regex search has run past its deadline."
+    if _limit.deadline and time.time() > _limit.deadline:
+        # sqlite checks for interrupts between rows, so the query stops
+        # after the current call returns
+        if not _limit.expired:
+            _limit.expired = True
+            _limit.db.interrupt()
+        return True
+    return False
+
+def registerFunctions(db):
+    "Make the functions searches use available to DB."
+    db.create_function("fieldmatch", 3, _fieldMatch)
+
 # Find and replace
 ##########################################################################
 
-def findReplace(col, nids, src, dst, regex=False, field=None, fold=True):
-    "Find and replace fields in a note."
+def findReplace(col, nids, src, dst, regex=False, field=None, fold=True,
+                progress=None, chunk=1000):
+    """Find and replace fields in a note. Notes are handled CHUNK at a time;
+    if provided, PROGRESS(done, total) is called after each chunk, and can
+    return True to stop early. Return the number of notes changed."""
     mmap = {}
     if field:
         for m in col.models.all():
@@ -476,16 +877,26 @@ def findReplace(col, nids, src, dst, regex=False, field=None, fold=True):
         src = "(?i)"+src
     regex = re.compile(src)
     def repl(str):
-        return re.sub(regex, dst, str)
+        return regex.sub(dst, str)
+    nids = list(nids)
+    total = len(nids)
+    changed = 0
+    for i in range(0, total, chunk):
+        changed += _replaceChunk(col, nids[i:i+chunk], repl, mmap)
+        if progress and progress(min(i+chunk, total), total):
+            break
+    return changed
+
+def _replaceChunk(col, nids, repl, mmap):
     d = []
-    snids = ids2str(nids)
-    nids = []
-    for nid, mid, flds in col.db.execute(
-        "select id, mid, flds from notes where id in "+snids):
-        origFlds = flds
-        # does it match?
-        sflds = splitFields(flds)
-        if field:
+    gen = []
+    mod = intTime()
+    usn = col.usn()
+    for nid, mid, flds in col.db.all(
+        "select id, mid, flds from notes where id in "+ids2str(nids)):
+        origFlds = splitFields(flds)
+        sflds = list(origFlds)
+        if mmap:
             try:
                 ord = mmap[str(mid)]
                 sflds[ord] = repl(sflds[ord])
@@ -495,19 +906,36 @@ def findReplace(col, nids, src, dst, regex=False, field=None, fold=True):
         else:
             for c in range(len(sflds)):
                 sflds[c] = repl(sflds[c])
-        flds = joinFields(sflds)
-        if flds != origFlds:
-            nids.append(nid)
-            d.append(dict(nid=nid,flds=flds,u=col.usn(),m=intTime()))
+        newFlds = joinFields(sflds)
+        # does it match?
+        if newFlds == flds:
+            continue
+        d.append((newFlds, mod, usn, nid))
+        if _mayAddCards(col.models.get(mid), origFlds, sflds):
+            gen.append(nid)
     if not d:
         return 0
     # replace
     col.db.executemany(
-        "update notes set flds=:flds,mod=:m,usn=:u where id=:nid", d)
-    col.updateFieldCache(nids)
-    col.genCards(nids)
+        "update notes set flds=?,mod=?,usn=? where id=?", d)
+    col.updateFieldCache([x[3] for x in d])
+    if gen:
+        col.genCards(gen)
     return len(d)
 
+def _mayAddCards(m, old, new):
+    "True if changing fields OLD to NEW could make more of M's cards exist."
+    if not m:
+        return False
+    if m['type'] == MODEL_CLOZE:
+        # cloze numbers may have changed
+        return True
+    # otherwise templates only care whether fields are empty
+    for o, n in zip(old, new):
+        if n.strip() and not o.strip():
+            return True
+    return False
+
 def fieldNames(col, downcase=True):
     fields = set()
     names = []
@@ -524,37 +952,115 @@ def fieldNames(col, downcase=True):
 ##########################################################################
 # returns array of ("dupestr", [nids])
 def findDupes(col, fieldName, search=""):
-    # limit search to notes with applicable field name
+    "Return [(value, [nid, ...]), ...] for notes sharing a FIELDNAME value."
+    return list(iterDupes(col, fieldName, search))
+
+def iterDupes(col, fieldName, search="", chunk=10000):
+    """Yield (value, [nid, ...]) for each group of notes sharing a FIELDNAME
+    value. Groups of notes that have the field first are yielded as they're
+    found; the rest once all notes have been read."""
+    # field ordinal for each note type with the field
+    ords = {}
+    for m in col.models.all():
+        for f in m['flds']:
+            if f['name'].lower() == fieldName.lower():
+                ords[int(m['id'])] = f['ord']
+                break
+    if not ords:
+        return
     if search:
-        search = "("+search+") "
-    search += "'%s:*'" % fieldName
-    # go through notes
+        nids = set(col.findNotes(search))
+    else:
+        nids = None
+    first = [mid for mid, ord in ords.items() if ord == 0]
+    rest = [mid for mid, ord in ords.items() if ord != 0]
+    # notes without the field first have to be read in full
     vals = {}
-    dupes = []
-    fields = {}
-    def ordForMid(mid):
-        if mid not in fields:
-            model = col.models.get(mid)
-            for c, f in enumerate(model['flds']):
-                if f['name'].lower() == fieldName.lower():
-                    fields[mid] = c
-                    break
-        return fields[mid]
-    for nid, mid, flds in col.db.all(
-        "select id, mid, flds from notes where id in "+ids2str(
-            col.findNotes(search))):
-        flds = splitFields(flds)
-        ord = ordForMid(mid)
-        if ord is None:
+    for nid, mid, flds in _noteChunks(col, "mid in " + ids2str(rest), chunk):
+        if nids is not None and nid not in nids:
             continue
-        val = flds[ord]
-        val = stripHTMLMedia(val)
+        val = _dupeValue(splitFields(flds)[ords[mid]])
         # empty does not count as duplicate
-        if not val:
-            continue
-        if val not in vals:
-            vals[val] = []
-        vals[val].append(nid)
-        if len(vals[val]) == 2:
-            dupes.append((val, vals[val]))
-    return dupes
+        if val:
+            vals.setdefault(val, []).append(nid)
+    # for the others the checksum of the first field is in the csum column,
+    # so only notes sharing a checksum need reading
+    restSums = {}
+    for val in vals:
+        restSums.setdefault(_dupeSum(val), []).append(val)
+    sums = {}
+    if first:
+        # notes of other types are skipped when they're read, as filtering
+        # them here would stop the csum index from covering the query
+        for csum, ids in col.db.execute(
+            "select csum, group_concat(id) from notes group by csum "
+            "having count() > 1"):
+            sums[csum] = [int(id) for id in ids.split(",")]
+        for nid, csum in col.db.execute(
+            "select id, csum from notes where csum in " + ids2str(
+                restSums.keys())):
+            if csum not in sums:
+                sums[csum] = [nid]
+    cands = []
+    for csum, ids in sums.items():
+        if nids is not None:
+            ids = sums[csum] = [id for id in ids if id in nids]
+        if len(ids) > 1 or (ids and csum in restSums):
+            cands.append(csum)
+    cands.sort()
+    first = set(first)
+    while cands:
+        batch = cands[:chunk]
+        cands = cands[chunk:]
+        # ids in a batch are read together, but groups are reported as
+        # each checksum is completed
+        ids = []
+        for csum in batch:
+            ids.extend(sums[csum])
+        found = {}
+        for lo in range(0, len(ids), chunk):
+            for nid, mid, flds in col.db.execute(
+                "select id, mid, flds from notes where id in " +
+                ids2str(ids[lo:lo+chunk])):
+                if mid in first:
+                    found[nid] = flds
+        for csum in batch:
+            group = {}
+            for val in restSums.get(csum, []):
+                group[val] = vals.pop(val)
+            for nid in sums[csum]:
+                if nid not in found:
+                    continue
+                val = _dupeValue(splitFields(found[nid])[0])
+                if val:
+                    group.setdefault(val, []).append(nid)
+            for val, ids in group.items():
+                if len(ids) > 1:
+                    yield val, sorted(ids)
+    for val, ids in vals.items():
+        if len(ids) > 1:
+            yield val, sorted(ids)
+
+def _noteChunks(col, lim, chunk):
+    "Yield (id, mid, flds) of notes matching LIM, reading CHUNK at a time."
+    lastId = 0
+    while 1:
+        rows = col.db.all(
+            "select id, mid, flds from notes where %s and id > ? order by id "
+            "limit %d" % (lim, chunk), lastId)
+        for row in rows:
+            yield row
+        if len(rows) < chunk:
+            return
+        lastId = rows[-1][0]
+
+def _dupeValue(val):
+    "Return field VAL with markup stripped, as duplicates are compared."
+    # most fields have no markup, and are the same after stripping
+    if "<" in val or "&" in val:
+        return stripHTMLMedia(val)
+    return val
+
+def _dupeSum(val):
+    "Return the csum of a note whose stripped first field is VAL."
+    return int(checksum(val)[:8], 16)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+An optional full text index of note fields, so that plain text searches don't
+need to scan the notes table.
+
+It uses SQLite's FTS5 trigram tokenizer, which can answer substring LIKE
+queries from the index, so searches match the same notes they would without
+it, except that markup is ignored: like the sort field, the index holds field
+text with HTML stripped.
+
+The index is kept up to date as notes are added, edited and removed. It
+records the collection's mod time when it was last updated, so if another
+client changes the collection, it's rebuilt on the next search. It's dropped
+before a full upload, and if it's enabled but missing when the collection is
+opened, an empty one is created and filled on the next search, provided this
+client's SQLite supports it. Clients whose SQLite can't support it ignore it.
+"""
+
+from anki.utils import ids2str, splitFields, stripHTMLMedia
+from anki.errors import AnkiError
+
+class TextIndex(object):
+
+    def __init__(self, col):
+        self.col = col
+        self._have = False
+        self._stale = False
+
+    def load(self):
+        self._stale = False
+        self._have = False
+        have = self.col.db.scalar(
+            "select 1 from sqlite_master where name = 'notes_fts'")
+        if not (have or self.col.conf.get("textIndex")):
+            return
+        if not self.available():
+            # the setting and table are synced, but this client's SQLite
+            # can't read or write the index, so searches don't use it
+            return
+        if not have:
+            self._create()
+            return
+        self._have = True
+        # not filled yet, or the notes were changed by a client that
+        # doesn't update it
+        self._stale = self.col.db.scalar(
+            "select mod from notes_ftsmod") != self.col.mod
+
+    def available(self):
+        "True if SQLite supports the index."
+        ver = self.col.db.scalar("select sqlite_version()")
+        if tuple(int(x) for x in ver.split(".")[:2]) < (3, 34):
+            # no trigram tokenizer
+            return False
+        return bool(self.col.db.scalar(
+            "select sqlite_compileoption_used('ENABLE_FTS5')"))
+
+    def enabled(self):
+        return self._have
+
+    # Enabling and disabling
+    ##########################################################################
+    # changing the schema commits the current transaction, so these save the
+    # collection first.
+
+    def enable(self):
+        "Build the index, and use it for searches from now on."
+        if self._have:
+            return
+        if not self.available():
+            raise AnkiError("textIndexUnavailable")
+        self.col.save()
+        self._create()
+        self.rebuild()
+        self.col.conf['textIndex'] = True
+        self.col.setMod()
+
+    def disable(self):
+        "Drop the index."
+        self.col.save()
+        self._drop()
+        self.col.conf['textIndex'] = False
+        self.col.setMod()
+
+    def beforeUpload(self):
+        # other clients wouldn't keep it up to date
+        self._drop()
+
+    def _create(self):
+        self.col.db.execute(
+            "create virtual table notes_fts using fts5(flds, tokenize=trigram)")
+        self.col.db.execute("create table notes_ftsmod (mod integer not null)")
+        self.col.db.execute("insert into notes_ftsmod values (0)")
+        self._have = True
+        self._stale = True
+
+    def _drop(self):
+        self.col.db.execute("drop table if exists notes_fts")
+        self.col.db.execute("drop table if exists notes_ftsmod")
+        self._have = False
+        self._stale = False
+
+    # Updating
+    ##########################################################################
+
+    def rebuild(self):
+        "Reindex all notes."
+        self.col.db.execute("delete from notes_fts")
+        lastId = 0
+        while 1:
+            rows = self.col.db.all(
+                "select id, flds from notes where id > ? order by id "
+                "limit 10000", lastId)
+            if not rows:
+                break
+            self._insert(rows)
+            lastId = rows[-1][0]
+        self._stale = False
+        self.stamp()
+
+    def stamp(self):
+        "Note the index is up to date as of the collection's mod time."
+        if self._have and not self._stale:
+            self.col.db.execute(
+                "update notes_ftsmod set mod = ?", self.col.mod)
+
+    def update(self, nids):
+        "Reindex NIDS, after their fields have changed."
+        if not self._have:
+            return
+        snids = ids2str(nids)
+        self.col.db.execute("delete from notes_fts where rowid in " + snids)
+        self._insert(self.col.db.all(
+            "select id, flds from notes where id in " + snids))
+
+    def remove(self, nids):
+        if not self._have:
+            return
+        self.col.db.execute(
+            "delete from notes_fts where rowid in " + ids2str(nids))
+
+    def _insert(self, rows):
+        self.col.db.executemany(
+            "insert into notes_fts (rowid, flds) values (?, ?)",
+            [(id, self._text(flds)) for id, flds in rows])
+
+    def _text(self, flds):
+        return u"\x1f".join(stripHTMLMedia(f) for f in splitFields(flds))
+
+    # Searching
+    ##########################################################################
+
+    def search(self, val, args):
+        "SQL matching notes with text LIKE %VAL%, or None if not indexed."
+        if not self._have:
+            return None
+        if self._stale:
+            self.rebuild()
+        args.append("%"+val+"%")
+        # the index can't be used for patterns with an escape clause
+        if "\\" in val:
+            return ("n.id in (select rowid from notes_fts "
+                    "where flds like ? escape '\\')")
+        return "n.id in (select rowid from notes_fts where flds like ?)"
+
+    def size(self):
+        "Return (indexed notes, bytes used), or None if not enabled."
+        if not self._have:
+            return None
+        notes = self.col.db.scalar("select count() from notes_fts")
+        bytes = (self.col.db.scalar(
+            "select sum(length(block)) from notes_fts_data") or 0) + (
+            self.col.db.scalar(
+                "select sum(length(c0)) from notes_fts_content") or 0)
+        return notes, bytes
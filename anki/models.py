@@ -8,6 +8,7 @@ from anki.utils import intTime, joinFields, splitFields, ids2str,\
 from anki.lang import _
 from anki.consts import *
 from anki.hooks import runHook
+import anki.template
 import time
 
 # Models
@@ -76,21 +77,30 @@ class ModelManager(object):
 
     def __init__(self, col):
         self.col = col
+        # bumped on every change, so derived data can be cached
+        self._gen = 0
+        self._compiled = {}
+        self._preds = {}
 
     def load(self, json_):
         "Load registry from JSON."
         self.changed = False
         self.models = json.loads(json_)
+        self._gen += 1
+        self._compiled = {}
 
     def save(self, m=None, templates=False):
         "Mark M modified if provided, and schedule registry flush."
         if m and m['id']:
             m['mod'] = intTime()
             m['usn'] = self.col.usn()
+            self._compiled = {}
+            self.col.qaCache.invalidate()
             self._updateRequired(m)
             if templates:
                 self._syncTemplates(m)
         self.changed = True
+        self._gen += 1
         runHook("newModel")
 
     def flush(self):
@@ -335,6 +345,7 @@ and notes.mid = ? and cards.ord = ?""", m['id'], ord)
                       intTime(), self.col.usn(), id))
         self.col.db.executemany(
             "update notes set flds=?,mod=?,usn=? where id = ?", r)
+        self.col.fts.update([x[3] for x in r])
 
     # Templates
     ##################################################
@@ -408,6 +419,16 @@ select id from notes where mid = ?)""" % " ".join(map),
     def _syncTemplates(self, m):
         rem = self.col.genCards(self.nids(m))
 
+    def compiledTemplate(self, m, ord, type, fmt):
+        "Return FMT, the TYPE format for card ORD of M, compiled."
+        # cached by model mod, but templates can be edited before they're
+        # saved, so the source is checked as well
+        key = (m['id'], ord, m['mod'], type)
+        c = self._compiled.get(key)
+        if not c or c.source != fmt:
+            c = self._compiled[key] = anki.template.CompiledTemplate(fmt)
+        return c
+
     # Model changing
     ##########################################################################
     # - maps are ord->ord, and there should not be duplicate targets
@@ -495,6 +516,42 @@ select id from notes where mid = ?)""" % " ".join(map),
         m['req'] = req
 
     def _reqForTemplate(self, m, flds, t):
+        "Return (type, fields) that card T requires, from its question format."
+        fmt = self.col._clozeFormat(t['qfmt'], "q", t['ord'])
+        c = self.compiledTemplate(m, t['ord'], "q", fmt)
+        if c.nodes is None:
+            return self._reqByRendering(m, flds, t)
+        # the same checks as _reqByRendering(), on the template's structure
+        consts = {'Tags': "", 'Type': m['name'], 'Card': t['name'],
+                  'Deck': self.col.decks.name(1), 'c%d' % (t['ord']+1): "1"}
+        items = c.analyse(flds, consts)
+        def show(present, value):
+            out = []
+            for conds, text, field in items:
+                for name, nonEmpty in conds:
+                    if (name in present) != nonEmpty:
+                        break
+                else:
+                    if field is None:
+                        out.append(text)
+                    elif field in present:
+                        out.append(value)
+            return "".join(out)
+        every = set(flds)
+        full = show(every, "ankiflag")
+        empty = show((), "")
+        if full == empty:
+            return "none", [], []
+        # required if no field content appears without it
+        req = [i for i, f in enumerate(flds)
+               if "ankiflag" not in show(every - set([f]), "ankiflag")]
+        if req:
+            return 'all', req
+        # otherwise, any field that changes the empty card
+        return 'any', [i for i, f in enumerate(flds)
+                       if show((f,), "1") != empty]
+
+    def _reqByRendering(self, m, flds, t):
         a = []
         b = []
         for f in flds:
@@ -535,35 +592,32 @@ select id from notes where mid = ?)""" % " ".join(map),
         "Given a joined field string, return available template ordinals."
         if m['type'] == MODEL_CLOZE:
             return self._availClozeOrds(m, flds)
-        fields = {}
-        for c, f in enumerate(splitFields(flds)):
-            fields[c] = f.strip()
-        avail = []
+        fields = [f.strip() for f in splitFields(flds)]
+        return [ord for ord, pred in self._reqPredicates(m) if pred(fields)]
+
+    def _reqPredicates(self, m):
+        "[(ord, fn)], where fn(stripped fields) is true if ord is available."
+        cached = self._preds.get(m['id'])
+        if cached and cached[0] == m['req']:
+            return cached[1]
+        preds = []
         for ord, type, req in m['req']:
             # unsatisfiable template
             if type == "none":
                 continue
-            # AND requirement?
-            elif type == "all":
-                ok = True
-                for idx in req:
-                    if not fields[idx]:
-                        # missing and was required
-                        ok = False
-                        break
-                if not ok:
-                    continue
-            # OR requirement?
-            elif type == "any":
-                ok = False
-                for idx in req:
-                    if fields[idx]:
-                        ok = True
-                        break
-                if not ok:
-                    continue
-            avail.append(ord)
-        return avail
+            preds.append((ord, self._reqPredicate(type, req)))
+        self._preds[m['id']] = (copy.deepcopy(m['req']), preds)
+        return preds
+
+    def _reqPredicate(self, type, req):
+        if len(req) == 1:
+            # the usual case
+            idx = req[0]
+            return lambda fields: fields[idx]
+        elif type == "all":
+            return lambda fields: all(fields[idx] for idx in req)
+        else:
+            return lambda fields: any(fields[idx] for idx in req)
 
     def _availClozeOrds(self, m, flds, allowEmpty=True):
         sflds = splitFields(flds)
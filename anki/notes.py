@@ -2,15 +2,19 @@
 # Copyright: Damien Elmes <anki@ichi2.net>
 # License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
 
+import anki.cards
 from anki.utils import fieldChecksum, intTime, \
     joinFields, splitFields, stripHTMLMedia, timestampID, guid64
 
 class Note(object):
 
-    def __init__(self, col, model=None, id=None):
+    def __init__(self, col, model=None, id=None, row=None):
         assert not (model and id)
         self.col = col
-        if id:
+        if row:
+            # already fetched, as by col.getNotes()
+            self._fromRow(row)
+        elif id:
             self.id = id
             self.load()
         else:
@@ -26,16 +30,20 @@ class Note(object):
             self.scm = self.col.scm
 
     def load(self):
-        (self.guid,
+        self._fromRow(self.col.db.first("""
+select id, guid, mid, mod, usn, tags, flds, flags, data
+from notes where id = ?""", self.id))
+
+    def _fromRow(self, row):
+        (self.id,
+         self.guid,
          self.mid,
          self.mod,
          self.usn,
          self.tags,
          self.fields,
          self.flags,
-         self.data) = self.col.db.first("""
-select guid, mid, mod, usn, tags, flds, flags, data
-from notes where id = ?""", self.id)
+         self.data) = row
         self.fields = splitFields(self.fields)
         self.tags = self.col.tags.split(self.tags)
         self._model = self.col.models.get(self.mid)
@@ -63,14 +71,17 @@ insert or replace into notes values (?,?,?,?,?,?,?,?,?,?,?)""",
                             fields, sfld, csum, self.flags,
                             self.data)
         self.col.tags.register(self.tags)
+        self.col.tags.updateIndex([self.id])
+        self.col.fts.update([self.id])
+        self.col.qaCache.invalidate([self.id])
         self._postFlush()
 
     def joinedFields(self):
         return joinFields(self.fields)
 
     def cards(self):
-        return [self.col.getCard(id) for id in self.col.db.list(
-            "select id from cards where nid = ? order by ord", self.id)]
+        return [anki.cards.Card(self.col, row=row) for row in self.col.db.all(
+            "select * from cards where nid = ? order by ord", self.id)]
 
     def model(self):
         return self._model
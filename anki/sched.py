@@ -29,9 +29,15 @@ class Scheduler(object):
         self.col = col
         self.queueLimit = 50
         self.reportLimit = 1000
+        self.prefetchLimit = 3
+        self.bulkChunk = 10000
         self.reps = 0
         self.today = None
         self._haveQueues = False
+        self._countCache = None
+        self._countWindow = False
+        self._ingest = None
+        self._prefetched = {}
         self._updateCutoff()
 
     def getCard(self):
@@ -58,9 +64,12 @@ class Scheduler(object):
     def answerCard(self, card, ease):
         self.col.log()
         assert ease >= 1 and ease <= 4
-        self.col.markReview(card)
+        fetchOk = self._prefetchValid()
+        if not self._ingest:
+            self.col.markReview(card)
         if self._burySiblingsOnAnswer:
             self._burySiblings(card)
+        cache = self._uncacheCards([card.id])
         card.reps += 1
         # former is for logging new cards, latter also covers filt. decks
         card.wasNew = card.type == 0
@@ -89,10 +98,110 @@ class Scheduler(object):
             self._updateStats(card, 'rev')
         else:
             raise Exception("Invalid queue")
-        self._updateStats(card, 'time', card.timeTaken())
-        card.mod = intTime()
+        self._updateStats(card, 'time', self._timeTaken(card))
+        card.mod = int(self._now())
         card.usn = self.col.usn()
-        card.flushSched()
+        if self._ingest:
+            self._stageCard(card)
+        else:
+            card.flushSched()
+        self._recacheCards([card.id], cache)
+        self._afterPrefetchAnswer(card, fetchOk)
+
+    def answerCards(self, answers):
+        """Answer cards in bulk, as if answerCard() was called for each.
+ANSWERS is a list of (cid, ease, timeTaken, timestamp), with timeTaken in
+milliseconds and timestamp in seconds. Cards and revlog entries are written
+with executemany() at the end, and no undo information is recorded. If an
+answer fails, nothing is written for the batch and the caller should roll
+back."""
+        if not self._haveQueues:
+            self.reset()
+        self.col.clearUndo()
+        # counts are rebuilt on the next reset
+        self._countCache = None
+        # revlog ids in use around the answer times
+        if answers:
+            stamps = [int(a[3]*1000) for a in answers]
+            used = set(self.col.db.list(
+                "select id from revlog where id between ? and ?",
+                min(stamps), max(stamps) + len(stamps)))
+        else:
+            used = set()
+        self._ingest = dict(cards={}, nids={}, revlog=[], used=used)
+        try:
+            for cid, ease, taken, stamp in answers:
+                card = self._ingest['cards'].get(cid)
+                if not card:
+                    card = self.col.getCard(cid)
+                # sibling burying needs the siblings' current state
+                if self._ingest['nids'].get(card.nid, set()) - set([cid]):
+                    self._flushIngest()
+                self._ingest['now'] = stamp
+                self._ingest['taken'] = taken
+                self.answerCard(card, ease)
+            self._flushIngest()
+        finally:
+            self._ingest = None
+        # in-memory queues no longer reflect the collection
+        self._haveQueues = False
+
+    def _stageCard(self, card):
+        # same checks as card.flushSched()
+        if card.queue == 2 and card.odue and not self.col.decks.isDyn(card.did):
+            runHook("odueInvalid")
+        assert card.due < 4294967296
+        self._ingest['cards'][card.id] = card
+        self._ingest['nids'].setdefault(card.nid, set()).add(card.id)
+
+    def _flushIngest(self):
+        "Write cards and revlog entries staged by answerCards()."
+        self.col.db.executemany("""
+update cards set
+mod=?, usn=?, type=?, queue=?, due=?, ivl=?, factor=?, reps=?,
+lapses=?, left=?, odue=?, odid=?, did=? where id = ?""", [
+            (c.mod, c.usn, c.type, c.queue, c.due, c.ivl, c.factor, c.reps,
+             c.lapses, c.left, c.odue, c.odid, c.did, c.id)
+            for c in self._ingest['cards'].values()])
+        self.col.db.executemany(
+            "insert into revlog values (?,?,?,?,?,?,?,?,?)",
+            self._ingest['revlog'])
+        self._ingest['cards'] = {}
+        self._ingest['nids'] = {}
+        self._ingest['revlog'] = []
+
+    def _now(self):
+        "The current time, or the time of the answer being ingested."
+        if self._ingest:
+            return self._ingest['now']
+        return time.time()
+
+    def _timeTaken(self, card):
+        if self._ingest:
+            return min(self._ingest['taken'], card.timeLimit())
+        return card.timeTaken()
+
+    def _writeRevlog(self, card, ease, ivl, lastIvl, type):
+        if self._ingest:
+            id = int(self._now()*1000)
+            while id in self._ingest['used']:
+                id += 1
+            self._ingest['used'].add(id)
+            self._ingest['revlog'].append((
+                id, card.id, self.col.usn(), ease, ivl, lastIvl,
+                card.factor, self._timeTaken(card), type))
+            return
+        def log():
+            self.col.db.execute(
+                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
+                int(time.time()*1000), card.id, self.col.usn(), ease,
+                ivl, lastIvl, card.factor, card.timeTaken(), type)
+        try:
+            log()
+        except:
+            # duplicate pk; retry in 10ms
+            time.sleep(0.01)
+            log()
 
     def counts(self, card=None):
         counts = [self.newCount, self.lrnCount, self.revCount]
@@ -122,6 +231,13 @@ order by due""" % self._deckLimit(),
         ret = [x[1] for x in sorted(daysd.items())]
         return ret
 
+    def simulatedForecast(self, days=7, runs=10):
+        """Return expected review counts over next DAYS, including reviews
+generated by answering cards in that period. Requires numpy."""
+        from anki.simulate import Simulator
+        sim = Simulator(self.col, self.col.decks.active())
+        return [int(round(x)) for x in sim.forecast(days, runs)['reviews']]
+
     def countIdx(self, card):
         if card.queue == 3:
             return 1
@@ -210,6 +326,110 @@ order by due""" % self._deckLimit(),
             tot += cnt
         return tot
 
+    # Count cache
+    ##########################################################################
+    # unlimited per-deck counts as returned by _groupedCounts(), used by
+    # reset() in place of per-deck queries. operations that know which cards
+    # they touch keep it up to date; anything else changing the DB is caught
+    # by comparing the connection's change counter and causes a recount.
+
+    def _countCacheValid(self):
+        return (self._countCache is not None and
+                self._countDb is self.col.db and
+                self._countChanges == self.col.db.totalChanges())
+
+    def _dueCounts(self):
+        if not self._countCacheValid():
+            self._countCache = self._groupedCounts(self.dayCutoff)
+            self._countWindow = False
+            self._countDb = self.col.db
+            self._countChanges = self.col.db.totalChanges()
+        return self._countCache
+
+    def _updateCountCache(self, cids, sign):
+        for did, cnts in self._groupedCounts(
+            self.dayCutoff, "and id in "+ids2str(cids)).items():
+            cur = self._countCache.setdefault(did, [0, 0, 0, 0, 0])
+            for c, n in enumerate(cnts):
+                cur[c] += sign*n
+
+    def _uncacheCards(self, cids):
+        "Call before modifying CIDS. Returns a token for _recacheCards()."
+        if self._countWindow or not self._countCacheValid():
+            # nested call, or nothing to maintain
+            return None
+        self._countWindow = True
+        self._updateCountCache(cids, -1)
+        return self._countCache
+
+    def _recacheCards(self, cids, cache):
+        "Call after modifying CIDS, with the token from _uncacheCards()."
+        if cache is None:
+            return
+        self._countWindow = False
+        # rebuilt in the mean time?
+        if cache is not self._countCache:
+            return
+        self._updateCountCache(cids, 1)
+        self._countChanges = self.col.db.totalChanges()
+
+    # Prefetching
+    ##########################################################################
+    # cards at the head of the queues can be loaded and rendered in advance,
+    # so that getCard() doesn't need to touch the DB. like the count cache,
+    # anything that modifies the DB invalidates them, apart from answering,
+    # which only discards the answered note's cards.
+
+    def prefetch(self):
+        "Load and render the cards likely to be shown next."
+        if not self._haveQueues:
+            return
+        if not self._prefetchValid():
+            self._prefetched = {}
+        n = self.prefetchLimit
+        ids = [x[1] for x in nsmallest(n, self._lrnQueue)]
+        ids += self._newQueue[-n:] + self._revQueue[-n:] + self._lrnDayQueue[-n:]
+        fetched = {}
+        for id in ids:
+            if id in self._prefetched:
+                fetched[id] = self._prefetched[id]
+        missing = [id for id in ids if id not in fetched]
+        for card in self.col.getCards(missing, notes=True):
+            # renders the question and answer
+            card._getQA()
+            fetched[card.id] = (card, self._prefetchKey(card))
+        self._prefetched = fetched
+        self._prefetchDb = self.col.db
+        self._prefetchChanges = self.col.db.totalChanges()
+
+    def _prefetchKey(self, card):
+        # things outside the DB that the rendered text depends on
+        return (card.model()['mod'],
+                self.col.decks.name(card.odid or card.did))
+
+    def _prefetchValid(self):
+        return (self._prefetched and self._prefetchDb is self.col.db and
+                self._prefetchChanges == self.col.db.totalChanges())
+
+    def _loadCard(self, id):
+        "Return card ID, from the prefetched cards if possible."
+        entry = self._prefetched.pop(id, None)
+        if entry and self._prefetchValid():
+            card, key = entry
+            if key == self._prefetchKey(card):
+                return card
+        return self.col.getCard(id)
+
+    def _afterPrefetchAnswer(self, card, ok):
+        if not self._prefetched:
+            return
+        # siblings may have been buried, and the note may have been tagged
+        for id, (c, key) in self._prefetched.items():
+            if c.nid == card.nid:
+                del self._prefetched[id]
+        if ok:
+            self._prefetchChanges = self.col.db.totalChanges()
+
     # Deck list
     ##########################################################################
 
@@ -219,6 +439,8 @@ order by due""" % self._deckLimit(),
         self.col.decks.recoverOrphans()
         decks = self.col.decks.all()
         decks.sort(key=itemgetter('name'))
+        counts = self._groupedCounts(
+            intTime() + self.col.conf['collapseTime'])
         lims = {}
         data = []
         def parent(name):
@@ -243,20 +465,46 @@ order by due""" % self._deckLimit(),
                     self.col.decks.rem(deck['id'], cardsToo=False, childrenToo=True)
                     return self.deckDueList()
                 nlim = min(nlim, lims[p][0])
-            new = self._newForDeck(deck['id'], nlim)
-            # learning
-            lrn = self._lrnForDeck(deck['id'])
+            cnt = counts.get(deck['id'])
+            if not cnt:
+                new = lrn = 0
+            else:
+                new = min(cnt[0], nlim, self.reportLimit)
+                # learning; if more than reportLimit cards are in the
+                # sub-day queue, defer to the per-deck query so the rows
+                # summed match the non-batched count
+                if cnt[4] > self.reportLimit:
+                    lrn = self._lrnForDeck(deck['id'])
+                else:
+                    lrn = cnt[3] + min(cnt[2], self.reportLimit)
             # reviews
             rlim = self._deckRevLimitSingle(deck)
             if p:
                 rlim = min(rlim, lims[p][1])
-            rev = self._revForDeck(deck['id'], rlim)
+            if cnt:
+                rev = min(cnt[1], rlim, self.reportLimit)
+            else:
+                rev = 0
             # save to list
             data.append([deck['name'], deck['id'], rev, lrn, new])
             # add deck as a parent
             lims[deck['name']] = [nlim, rlim]
         return data
 
+    def _groupedCounts(self, lrnCutoff, lim=""):
+        """Unlimited counts for every deck, gathered in a single pass.
+Returns {did: [new, rev, dayLrn, lrn, lrnCards]}."""
+        counts = {}
+        for row in self.col.db.execute("""
+select did, sum(queue = 0), sum(queue = 2 and due <= :today),
+sum(queue = 3 and due <= :today),
+sum(case when queue = 1 and due < :lrn then left/1000 else 0 end),
+sum(queue = 1 and due < :lrn) from cards
+where queue in (0,1,2,3) %s group by did""" % lim,
+                today=self.today, lrn=lrnCutoff):
+            counts[row[0]] = list(row[1:])
+        return counts
+
     def deckDueTree(self):
         return self._groupChildren(self.deckDueList())
 
@@ -340,9 +588,8 @@ order by due""" % self._deckLimit(),
     ##########################################################################
 
     def _resetNewCount(self):
-        cntFn = lambda did, lim: self.col.db.scalar("""
-select count() from (select 1 from cards where
-did = ? and queue = 0 limit ?)""", did, lim)
+        counts = self._dueCounts()
+        cntFn = lambda did, lim: min(counts.get(did, [0])[0], lim)
         self.newCount = self._walkingCount(self._deckNewLimitSingle, cntFn)
 
     def _resetNew(self):
@@ -378,7 +625,7 @@ select id from cards where did = ? and queue = 0 order by due limit ?""", did, l
     def _getNewCard(self):
         if self._fillNew():
             self.newCount -= 1
-            return self.col.getCard(self._newQueue.pop())
+            return self._loadCard(self._newQueue.pop())
 
     def _updateNewCardRatio(self):
         if self.col.conf['newSpread'] == NEW_CARDS_DISTRIBUTE:
@@ -443,17 +690,24 @@ select id from cards where did in %s and queue = 0 limit ?)"""
     ##########################################################################
 
     def _resetLrnCount(self):
+        counts = self._dueCounts()
+        lrn = lrnCards = day = 0
+        for did in self.col.decks.active():
+            cnt = counts.get(int(did))
+            if cnt:
+                day += cnt[2]
+                lrn += cnt[3]
+                lrnCards += cnt[4]
         # sub-day
-        self.lrnCount = self.col.db.scalar("""
+        if lrnCards > self.reportLimit:
+            # only the first reportLimit cards are counted
+            lrn = self.col.db.scalar("""
 select sum(left/1000) from (select left from cards where
 did in %s and queue = 1 and due < ? limit %d)""" % (
-            self._deckLimit(), self.reportLimit),
-            self.dayCutoff) or 0
+                self._deckLimit(), self.reportLimit),
+                self.dayCutoff) or 0
         # day
-        self.lrnCount += self.col.db.scalar("""
-select count() from cards where did in %s and queue = 3
-and due <= ? limit %d""" % (self._deckLimit(), self.reportLimit),
-                                            self.today)
+        self.lrnCount = lrn + day
 
     def _resetLrn(self):
         self._resetLrnCount()
@@ -482,7 +736,7 @@ limit %d""" % (self._deckLimit(), self.reportLimit), lim=self.dayCutoff)
                 cutoff += self.col.conf['collapseTime']
             if self._lrnQueue[0][0] < cutoff:
                 id = heappop(self._lrnQueue)[1]
-                card = self.col.getCard(id)
+                card = self._loadCard(id)
                 self.lrnCount -= card.left // 1000
                 return card
 
@@ -514,7 +768,7 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _getLrnDayCard(self):
         if self._fillLrnDay():
             self.lrnCount -= 1
-            return self.col.getCard(self._lrnDayQueue.pop())
+            return self._loadCard(self._lrnDayQueue.pop())
 
     def _answerLrnCard(self, card, ease):
         # ease 1=no, 2=yes, 3=remove
@@ -555,10 +809,10 @@ did = ? and queue = 3 and due <= ? limit ?""",
                 if resched and card.odid:
                     card.odue = self.today + 1
             delay = self._delayForGrade(conf, card.left)
-            if card.due < time.time():
+            if card.due < self._now():
                 # not collapsed; add some randomness
                 delay *= random.uniform(1, 1.25)
-            card.due = int(time.time() + delay)
+            card.due = int(self._now() + delay)
             # due today?
             if card.due < self.dayCutoff:
                 self.lrnCount += card.left // 1000
@@ -631,7 +885,7 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _leftToday(self, delays, left, now=None):
         "The number of steps that can be completed by the day cutoff."
         if not now:
-            now = intTime()
+            now = int(self._now())
         delays = delays[-left:]
         ok = 0
         for i in range(len(delays)):
@@ -668,17 +922,7 @@ did = ? and queue = 3 and due <= ? limit ?""",
     def _logLrn(self, card, ease, conf, leaving, type, lastLeft):
         lastIvl = -(self._delayForGrade(conf, lastLeft))
         ivl = card.ivl if leaving else -(self._delayForGrade(conf, card.left))
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                ivl, lastIvl, card.factor, card.timeTaken(), type)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self._writeRevlog(card, ease, ivl, lastIvl, type)
 
     def removeLrn(self, ids=None):
         "Remove cards from the learning queues."
@@ -734,11 +978,9 @@ and due <= ? limit ?)""",
             did, self.today, lim)
 
     def _resetRevCount(self):
+        counts = self._dueCounts()
         def cntFn(did, lim):
-            return self.col.db.scalar("""
-select count() from (select id from cards where
-did = ? and queue = 2 and due <= ? limit %d)""" % lim,
-                                      did, self.today)
+            return min(counts.get(did, [0, 0])[1], lim)
         self.revCount = self._walkingCount(
             self._deckRevLimitSingle, cntFn)
 
@@ -787,7 +1029,7 @@ did = ? and queue = 2 and due <= ? limit ?""",
     def _getRevCard(self):
         if self._fillRev():
             self.revCount -= 1
-            return self.col.getCard(self._revQueue.pop())
+            return self._loadCard(self._revQueue.pop())
 
     def totalRevForCurrentDeck(self):
         return self.col.db.scalar(
@@ -829,7 +1071,7 @@ select id from cards where did in %s and queue = 2 and due <= ? limit ?)"""
         if not card.odue:
             card.odue = card.due
         delay = self._delayForGrade(conf, 0)
-        card.due = int(delay + time.time())
+        card.due = int(delay + self._now())
         card.left = self._startingLeft(card)
         # queue 1
         if card.due < self.dayCutoff:
@@ -862,18 +1104,7 @@ select id from cards where did in %s and queue = 2 and due <= ? limit ?)"""
             card.odue = 0
 
     def _logRev(self, card, ease, delay):
-        def log():
-            self.col.db.execute(
-                "insert into revlog values (?,?,?,?,?,?,?,?,?)",
-                int(time.time()*1000), card.id, self.col.usn(), ease,
-                -delay or card.ivl, card.lastIvl, card.factor, card.timeTaken(),
-                1)
-        try:
-            log()
-        except:
-            # duplicate pk; retry in 10ms
-            time.sleep(0.01)
-            log()
+        self._writeRevlog(card, ease, -delay or card.ivl, card.lastIvl, 1)
 
     # Interval management
     ##########################################################################
@@ -937,14 +1168,18 @@ select id from cards where did in %s and queue = 2 and due <= ? limit ?)"""
     # Dynamic deck handling
     ##########################################################################
 
-    def rebuildDyn(self, did=None):
-        "Rebuild a dynamic deck."
+    def rebuildDyn(self, did=None, incremental=False):
+        """Rebuild a dynamic deck. If INCREMENTAL, cards that still match keep
+their position and state, and only cards entering or leaving are modified."""
         did = did or self.col.decks.selected()
         deck = self.col.decks.get(did)
         assert deck['dyn']
-        # move any existing cards back first, then fill
-        self.emptyDyn(did)
-        ids = self._fillDyn(deck)
+        if incremental:
+            ids = self._refillDyn(deck)
+        else:
+            # move any existing cards back first, then fill
+            self.emptyDyn(did)
+            ids = self._fillDyn(deck)
         if not ids:
             return
         # and change to our new deck
@@ -952,29 +1187,77 @@ select id from cards where did in %s and queue = 2 and due <= ? limit ?)"""
         return ids
 
     def _fillDyn(self, deck):
+        ids = self._searchDyn(deck)
+        if not ids:
+            return ids
+        # move the cards over
+        self.col.log(deck['id'], ids)
+        self._moveToDyn(deck['id'], ids)
+        return ids
+
+    def _searchDyn(self, deck):
         search, limit, order = deck['terms'][0]
         orderlimit = self._dynOrder(order, limit)
         search += " -is:suspended -is:buried -deck:filtered"
         try:
-            ids = self.col.findCards(search, order=orderlimit)
+            return self.col.findCards(search, order=orderlimit)
         except:
-            ids = []
-            return ids
-        # move the cards over
-        self.col.log(deck['id'], ids)
-        self._moveToDyn(deck['id'], ids)
+            return []
+
+    def _refillDyn(self, deck):
+        did = deck['id']
+        old = {}
+        for id, type, queue, due, mod, usn in self.col.db.execute(
+            "select id, type, queue, due, mod, usn from cards where did = ?",
+            did):
+            old[id] = (type, queue, due, mod, usn)
+        # the search needs to see current cards in their home decks. this
+        # doesn't update mod, as cards that still match are put back below
+        self._returnFromDyn("did = %d" % did)
+        ids = self._searchDyn(deck)
+        new = set(ids)
+        kept = [id for id in ids if id in old]
+        left = [id for id in old if id not in new]
+        entered = [id for id in ids if id not in old]
+        def restore(chunk):
+            self.col.db.executemany("""
+update cards set odid = did, odue = due, did = ?, type = ?, queue = ?,
+due = ?, mod = ?, usn = ? where id = ?""",
+                ((did,)+old[id]+(id,) for id in chunk))
+        self._bulk(kept, restore)
+        mod = intTime()
+        usn = self.col.usn()
+        def touch(chunk):
+            self.col.db.execute(
+                "update cards set mod = ?, usn = ? where id in "+ids2str(chunk),
+                mod, usn)
+        self._bulk(left, touch)
+        if left:
+            self.col.log(left)
+        if entered:
+            # after the last positioned card. learning cards are due by time
+            start = max([old[id][2] for id in kept
+                         if old[id][1] in (0, 2)] or [-100001]) + 1
+            self.col.log(did, entered)
+            self._moveToDyn(did, entered, start)
         return ids
 
     def emptyDyn(self, did, lim=None):
         if not lim:
             lim = "did = %s" % did
-        self.col.log(self.col.db.list("select id from cards where %s" % lim))
-        # move out of cram queue
+        cids = self.col.db.list("select id from cards where %s" % lim)
+        self.col.log(cids)
+        cache = self._uncacheCards(cids)
+        self._returnFromDyn(
+            lim, ", usn = %d, mod = %d" % (self.col.usn(), intTime()))
+        self._recacheCards(cids, cache)
+
+    def _returnFromDyn(self, lim, extra=""):
+        "Move cards matching LIM out of cram queue and back to their home deck."
         self.col.db.execute("""
 update cards set did = odid, queue = (case when type = 1 then 0
 else type end), type = (case when type = 1 then 0 else type end),
-due = odue, odue = 0, odid = 0, usn = ?, mod = ? where %s""" % lim,
-                            self.col.usn(), intTime())
+due = odue, odue = 0, odid = 0%s where %s""" % (extra, lim))
 
     def remFromDyn(self, cids):
         self.emptyDyn(None, "id in %s and odid" % ids2str(cids))
@@ -1004,24 +1287,26 @@ due = odue, odue = 0, odid = 0, usn = ?, mod = ? where %s""" % lim,
             t = "c.due"
         return t + " limit %d" % l
 
-    def _moveToDyn(self, did, ids):
+    def _moveToDyn(self, did, ids, start=-100000):
         deck = self.col.decks.get(did)
         data = []
         t = intTime(); u = self.col.usn()
         for c, id in enumerate(ids):
             # start at -100000 so that reviews are all due
-            data.append((did, -100000+c, t, u, id))
+            data.append((did, start+c, t, u, id))
         # due reviews stay in the review queue. careful: can't use
         # "odid or did", as sqlite converts to boolean
         queue = """
 (case when type=2 and (case when odue then odue <= %d else due <= %d end)
  then 2 else 0 end)"""
         queue %= (self.today, self.today)
+        cache = self._uncacheCards(ids)
         self.col.db.executemany("""
 update cards set
 odid = (case when odid then odid else did end),
 odue = (case when odue then odue else due end),
 did = ?, queue = %s, due = ?, mod = ?, usn = ? where id = ?""" % queue, data)
+        self._recacheCards(ids, cache)
 
     def _dynIvlBoost(self, card):
         assert card.odid and card.type == 2
@@ -1134,6 +1419,8 @@ did = ?, queue = %s, due = ?, mod = ?, usn = ? where id = ?""" % queue, data)
         self.dayCutoff = self.col.crt + (self.today+1)*86400
         if oldToday != self.today:
             self.col.log(self.today, self.dayCutoff)
+            # due counts depend on the day
+            self._countCache = None
         # update all daily counts, but don't save decks to prevent needless
         # conflicts. we'll save on card answer instead
         def update(g):
@@ -1151,6 +1438,7 @@ did = ?, queue = %s, due = ?, mod = ?, usn = ? where id = ?""" % queue, data)
     def _checkDay(self):
         # check if the day has rolled over
         if time.time() > self.dayCutoff:
+            self._countCache = None
             self.reset()
 
     # Deck finished state
@@ -1263,27 +1551,33 @@ To study outside of the normal schedule, click the Custom Study button below."""
     def suspendCards(self, ids):
         "Suspend cards."
         self.col.log(ids)
+        cache = self._uncacheCards(ids)
         self.remFromDyn(ids)
         self.removeLrn(ids)
         self.col.db.execute(
             "update cards set queue=-1,mod=?,usn=? where id in "+
             ids2str(ids), intTime(), self.col.usn())
+        self._recacheCards(ids, cache)
 
     def unsuspendCards(self, ids):
         "Unsuspend cards."
         self.col.log(ids)
+        cache = self._uncacheCards(ids)
         self.col.db.execute(
             "update cards set queue=type,mod=?,usn=? "
             "where queue = -1 and id in "+ ids2str(ids),
             intTime(), self.col.usn())
+        self._recacheCards(ids, cache)
 
     def buryCards(self, cids):
         self.col.log(cids)
+        cache = self._uncacheCards(cids)
         self.remFromDyn(cids)
         self.removeLrn(cids)
         self.col.db.execute("""
 update cards set queue=-2,mod=?,usn=? where id in """+ids2str(cids),
                             intTime(), self.col.usn())
+        self._recacheCards(cids, cache)
 
     def buryNote(self, nid):
         "Bury all cards for note until next session."
@@ -1323,69 +1617,104 @@ and (queue=0 or (queue=2 and due<=?))""",
                     pass
         # then bury
         if toBury:
+            cache = self._uncacheCards(toBury)
             self.col.db.execute(
                 "update cards set queue=-2,mod=?,usn=? where id in "+ids2str(toBury),
                 intTime(), self.col.usn())
+            self._recacheCards(toBury, cache)
             self.col.log(toBury)
 
     # Resetting
     ##########################################################################
 
-    def forgetCards(self, ids):
+    def forgetCards(self, ids, progress=None):
         "Put cards at the end of the new queue."
+        cache = self._uncacheCards(ids)
         self.remFromDyn(ids)
-        self.col.db.execute(
-            "update cards set type=0,queue=0,ivl=0,due=0,odue=0,factor=?"
-            " where id in "+ids2str(ids), 2500)
+        def forget(chunk):
+            self.col.db.execute(
+                "update cards set type=0,queue=0,ivl=0,due=0,odue=0,factor=?"
+                " where id in "+ids2str(chunk), 2500)
+        self._bulk(ids, forget)
         pmax = self.col.db.scalar(
             "select max(due) from cards where type=0") or 0
         # takes care of mod + usn
-        self.sortCards(ids, start=pmax+1)
+        self.sortCards(ids, start=pmax+1, progress=progress)
+        self._recacheCards(ids, cache)
         self.col.log(ids)
 
-    def reschedCards(self, ids, imin, imax):
+    def reschedCards(self, ids, imin, imax, progress=None):
         "Put cards in review queue with a new interval in days (min, max)."
-        d = []
         t = self.today
         mod = intTime()
-        for id in ids:
-            r = random.randint(imin, imax)
-            d.append(dict(id=id, due=r+t, ivl=max(1, r), mod=mod,
-                          usn=self.col.usn(), fact=2500))
+        usn = self.col.usn()
+        span = imax - imin + 1
+        cache = self._uncacheCards(ids)
         self.remFromDyn(ids)
-        self.col.db.executemany("""
-update cards set type=2,queue=2,ivl=:ivl,due=:due,odue=0,
-usn=:usn,mod=:mod,factor=:fact where id=:id""",
-                                d)
+        def resched(chunk):
+            sids = ids2str(chunk)
+            # pick a due date in SQL, then derive the interval from it
+            self.col.db.execute("""
+update cards set type=2,queue=2,odue=0,usn=?,mod=?,factor=?,
+due=?+((random()%%?)+?)%%? where id in %s""" % sids,
+                usn, mod, 2500, t+imin, span, span, span)
+            self.col.db.execute(
+                "update cards set ivl=max(1,due-?) where id in %s" % sids, t)
+        self._bulk(ids, resched, progress)
+        self._recacheCards(ids, cache)
         self.col.log(ids)
 
-    def resetCards(self, ids):
+    def resetCards(self, ids, progress=None):
         "Completely reset cards for export."
-        sids = ids2str(ids)
-        # we want to avoid resetting due number of existing new cards on export
-        nonNew = self.col.db.list(
-            "select id from cards where id in %s and (queue != 0 or type != 0)"
-            % sids)
-        # reset all cards
-        self.col.db.execute(
-            "update cards set reps=0,lapses=0,odid=0,odue=0,queue=0"
-            " where id in %s" % sids
-        )
+        nonNew = []
+        def reset(chunk):
+            sids = ids2str(chunk)
+            # we want to avoid resetting due number of existing new cards on
+            # export
+            nonNew.extend(self.col.db.list(
+                "select id from cards where id in %s and "
+                "(queue != 0 or type != 0)" % sids))
+            self.col.db.execute(
+                "update cards set reps=0,lapses=0,odid=0,odue=0,queue=0"
+                " where id in %s" % sids)
+        self._bulk(ids, reset)
         # and forget any non-new cards, changing their due numbers
-        self.forgetCards(nonNew)
+        self.forgetCards(nonNew, progress)
         self.col.log(ids)
 
+    def _bulk(self, ids, fn, progress=None):
+        """Call FN with successive chunks of IDS, so each statement stays small.
+If provided, PROGRESS(done, total) is called after each chunk."""
+        total = len(ids)
+        for i in range(0, total, self.bulkChunk):
+            chunk = ids[i:i+self.bulkChunk]
+            fn(chunk)
+            if progress:
+                progress(i+len(chunk), total)
+
     # Repositioning new cards
     ##########################################################################
 
-    def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False):
-        scids = ids2str(cids)
+    def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False,
+                  progress=None):
         now = intTime()
+        usn = self.col.usn()
+        # note of each card, and new cards to reposition
+        nidFor = {}
+        newCids = []
+        def fetch(chunk):
+            for id, nid, type in self.col.db.execute(
+                "select id, nid, type from cards where id in "+ids2str(chunk)):
+                nidFor[id] = nid
+                if type == 0:
+                    newCids.append(id)
+        self._bulk(cids, fetch)
+        # notes in the order their cards were provided
         nids = []
         nidsSet = set()
         for id in cids:
-            nid = self.col.db.scalar("select nid from cards where id = ?", id)
-            if nid not in nidsSet:
+            nid = nidFor.get(id)
+            if nid is not None and nid not in nidsSet:
                 nids.append(nid)
                 nidsSet.add(nid)
         if not nids:
@@ -1400,6 +1729,7 @@ usn=:usn,mod=:mod,factor=:fact where id=:id""",
         high = start+c*step
         # shift?
         if shift:
+            scids = ids2str(cids)
             low = self.col.db.scalar(
                 "select min(due) from cards where due >= ? and type = 0 "
                 "and id not in %s" % scids,
@@ -1408,14 +1738,13 @@ usn=:usn,mod=:mod,factor=:fact where id=:id""",
                 shiftby = high - low + 1
                 self.col.db.execute("""
 update cards set mod=?, usn=?, due=due+? where id not in %s
-and due >= ? and queue = 0""" % scids, now, self.col.usn(), shiftby, low)
+and due >= ? and queue = 0""" % scids, now, usn, shiftby, low)
         # reorder cards
-        d = []
-        for id, nid in self.col.db.execute(
-            "select id, nid from cards where type = 0 and id in "+scids):
-            d.append(dict(now=now, due=due[nid], usn=self.col.usn(), cid=id))
-        self.col.db.executemany(
-            "update cards set due=:due,mod=:now,usn=:usn where id = :cid", d)
+        def reorder(chunk):
+            self.col.db.executemany(
+                "update cards set due=?,mod=?,usn=? where id = ?",
+                ((due[nidFor[id]], now, usn, id) for id in chunk))
+        self._bulk(newCids, reorder, progress)
 
     def randomizeCards(self, did):
         cids = self.col.db.list("select id from cards where did = ?", did)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+
+"""
+Workload simulation. Unlike Scheduler.dueForecast(), which only counts cards
+that are already scheduled, this projects the reviews that future answers
+will create, by answering each day's due cards at random according to the
+collection's answer history.
+
+The interval math mirrors Scheduler._nextRevIvl() and _fuzzIvlRange(), but is
+applied to all of a day's due cards at once. Learning steps are not
+simulated: new cards graduate on the day they are introduced, and lapsed
+cards return to the review queue the following day. Parent deck limits are
+ignored.
+
+Requires numpy.
+"""
+
+from __future__ import division
+
+from anki.utils import ids2str
+from anki.errors import AnkiError
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# used when the collection has no review history
+defaultRetention = 0.9
+defaultEases = (0.1, 0.8, 0.1)
+
+class Simulator(object):
+
+    def __init__(self, col, dids=None):
+        if np is None:
+            raise AnkiError("numpyMissing")
+        self.col = col
+        self.dids = dids
+        self.today = col.sched.today
+        self._load()
+
+    # Loading
+    ######################################################################
+
+    def _load(self):
+        if self.dids is not None:
+            sids = ids2str(self.dids)
+            lim = "and (did in %s or odid in %s)" % (sids, sids)
+        else:
+            lim = ""
+        # cards in filtered decks are scheduled by their home deck
+        rows = self.col.db.all("""
+select (case when odid then odid else did end), queue, type,
+(case when odid then odue else due end), odue, ivl, factor from cards
+where queue in (0,1,2,3) %s""" % lim)
+        if rows:
+            cards = np.array(rows, dtype=np.int64)
+        else:
+            cards = np.zeros((0, 7), dtype=np.int64)
+        (home, self.queue, self.type, self.due, self.odue,
+         self.ivl, self.factor) = cards.T
+        self._loadConf(home)
+        self._loadNew()
+        self._loadHistory()
+
+    def _loadConf(self, home):
+        "Per-card deck option arrays, and each card's deck index."
+        dids, self.deck = np.unique(home, return_inverse=True)
+        confs = []
+        confIdx = {}
+        deckConf = []
+        for did in dids:
+            deck = self.col.decks.get(int(did))
+            if deck['dyn']:
+                # shouldn't happen; fall back to the default options
+                deck = self.col.decks.get(1)
+            conf = self.col.decks.confForDid(deck['id'])
+            if conf['id'] not in confIdx:
+                confIdx[conf['id']] = len(confs)
+                confs.append(conf)
+            deckConf.append(confIdx[conf['id']])
+        deckConf = np.array(deckConf, dtype=np.int64)
+        def perDeck(fn, dtype=np.float64):
+            return np.array([fn(c) for c in confs], dtype=dtype)[deckConf]
+        def perCard(fn, dtype=np.float64):
+            return perDeck(fn, dtype)[self.deck]
+        self.ease4 = perCard(lambda c: c['rev']['ease4'])
+        self.ivlFct = perCard(lambda c: c['rev'].get('ivlFct', 1))
+        self.maxIvl = perCard(lambda c: c['rev']['maxIvl'], np.int64)
+        self.minInt = perCard(lambda c: c['lapse']['minInt'], np.int64)
+        self.mult = perCard(lambda c: c['lapse']['mult'])
+        self.initFactor = perCard(
+            lambda c: c['new']['initialFactor'], np.int64)
+        self.gradIvl = perCard(lambda c: c['new']['ints'][0], np.int64)
+        self.newPerDay = perCard(lambda c: c['new']['perDay'], np.int64)
+        self.revPerDay = perDeck(lambda c: c['rev']['perDay'], np.int64)
+
+    def _loadNew(self):
+        "Order new cards by the day they'll be introduced."
+        idx = np.flatnonzero(self.queue == 0)
+        # in due order within each deck
+        idx = idx[np.lexsort((self.due[idx], self.deck[idx]))]
+        rank = self._rankInGroup(self.deck[idx])
+        perDay = self.newPerDay[idx]
+        day = np.where(perDay > 0, rank // np.maximum(perDay, 1),
+                       np.iinfo(np.int64).max)
+        order = np.argsort(day, kind='mergesort')
+        self.newIdx = idx[order]
+        self.newDay = day[order]
+
+    def _loadHistory(self):
+        "Retention and ease distribution of past reviews."
+        cnts = dict(self.col.db.all(
+            "select ease, count() from revlog where type = 1 group by ease"))
+        total = sum(cnts.values())
+        passed = total - cnts.get(1, 0)
+        if not passed:
+            self.retention = defaultRetention
+            self.eases = np.array(defaultEases)
+            return
+        self.retention = passed / total
+        self.eases = np.array([cnts.get(e, 0) / passed for e in (2, 3, 4)])
+
+    # Simulation
+    ######################################################################
+
+    def forecast(self, days=365, runs=10, seed=None, limits=True):
+        """Project daily workload over the next DAYS, averaged over RUNS.
+Returns a dict of lists with a value for each day, starting today:
+reviews, lapses (failed reviews) and new (cards introduced). If LIMITS is
+true, deck review limits push excess reviews to the following day."""
+        rng = np.random.RandomState(seed)
+        tot = dict(reviews=np.zeros(days), lapses=np.zeros(days),
+                   new=np.zeros(days))
+        for run in range(runs):
+            for k, v in self._run(rng, days, limits).items():
+                tot[k] += v
+        return dict((k, list(v / max(runs, 1))) for k, v in tot.items())
+
+    def _run(self, rng, days, limits):
+        today = self.today
+        reviews = np.zeros(days)
+        lapses = np.zeros(days)
+        new = np.zeros(days)
+        due = self.due.copy()
+        ivl = self.ivl.copy()
+        factor = self.factor.copy()
+        # new cards don't come due until introduced
+        due[self.queue == 0] = np.iinfo(np.int64).max
+        # learning cards graduate today, or go back to their review due date
+        lrn = (self.queue == 1) | (self.queue == 3)
+        relrn = np.flatnonzero(lrn & (self.type == 2))
+        due[relrn] = np.maximum(today + 1, self.odue[relrn])
+        self._graduate(rng, np.flatnonzero(lrn & (self.type != 2)),
+                       today, due, ivl, factor)
+        bounds = np.searchsorted(self.newDay, np.arange(days + 1))
+        for day in range(days):
+            d = today + day
+            # introduce new cards
+            idx = self.newIdx[bounds[day]:bounds[day+1]]
+            new[day] = len(idx)
+            self._graduate(rng, idx, d, due, ivl, factor)
+            # answer due reviews
+            idx = np.flatnonzero(due <= d)
+            if limits:
+                idx = self._limit(rng, idx)
+            if not len(idx):
+                continue
+            reviews[day] = len(idx)
+            failed = rng.random_sample(len(idx)) >= self.retention
+            lapses[day] = failed.sum()
+            self._lapse(idx[failed], d, due, ivl, factor)
+            self._review(rng, idx[~failed], d, due, ivl, factor)
+        return dict(reviews=reviews, lapses=lapses, new=new)
+
+    def _limit(self, rng, idx):
+        "Random selection of IDX within each deck's review limit."
+        idx = idx[rng.permutation(len(idx))]
+        idx = idx[np.argsort(self.deck[idx], kind='mergesort')]
+        decks = self.deck[idx]
+        return idx[self._rankInGroup(decks) < self.revPerDay[decks]]
+
+    def _rankInGroup(self, keys):
+        "Position of each element within its run of equal sorted KEYS."
+        pos = np.arange(len(keys))
+        return pos - np.searchsorted(keys, keys)
+
+    # Answering
+    ######################################################################
+
+    def _graduate(self, rng, idx, d, due, ivl, factor):
+        # see Scheduler._rescheduleNew()
+        ivl[idx] = self._fuzzedIvl(rng, self.gradIvl[idx])
+        factor[idx] = self.initFactor[idx]
+        due[idx] = d + ivl[idx]
+
+    def _lapse(self, idx, d, due, ivl, factor):
+        # see Scheduler._rescheduleLapse(); relearning finishes today
+        ivl[idx] = np.maximum(
+            self.minInt[idx], (ivl[idx]*self.mult[idx]).astype(np.int64))
+        factor[idx] = np.maximum(1300, factor[idx] - 200)
+        due[idx] = d + np.maximum(1, ivl[idx])
+
+    def _review(self, rng, idx, d, due, ivl, factor):
+        # see Scheduler._rescheduleRev()
+        ease = rng.choice([2, 3, 4], size=len(idx), p=self.eases)
+        cur = ivl[idx]
+        fct = factor[idx] / 1000
+        delay = np.maximum(0, d - due[idx])
+        ivlFct = self.ivlFct[idx]
+        def constrained(new, prev):
+            return np.maximum(new*ivlFct, prev+1).astype(np.int64)
+        ivl2 = constrained((cur + delay // 4) * 1.2, cur)
+        ivl3 = constrained((cur + delay // 2) * fct, ivl2)
+        ivl4 = constrained((cur + delay) * fct * self.ease4[idx], ivl3)
+        new = np.choose(ease - 2, (ivl2, ivl3, ivl4))
+        new = np.minimum(new, self.maxIvl[idx])
+        ivl[idx] = self._fuzzedIvl(rng, new)
+        factor[idx] = np.maximum(
+            1300, factor[idx] + np.choose(ease - 2, (-150, 0, 150)))
+        due[idx] = d + ivl[idx]
+
+    def _fuzzedIvl(self, rng, ivl):
+        "Vectorized Scheduler._fuzzedIvl()."
+        fuzz = np.where(
+            ivl < 7, (ivl*0.25).astype(np.int64), np.where(
+                ivl < 30, np.maximum(2, (ivl*0.15).astype(np.int64)),
+                np.maximum(4, (ivl*0.05).astype(np.int64))))
+        fuzz = np.maximum(fuzz, 1)
+        lo = ivl - fuzz
+        hi = ivl + fuzz
+        # special cases for small intervals
+        lo = np.where(ivl < 2, 1, np.where(ivl == 2, 2, lo))
+        hi = np.where(ivl < 2, 1, np.where(ivl == 2, 3, hi))
+        span = hi - lo + 1
+        return lo + (rng.random_sample(len(ivl)) * span).astype(np.int64)
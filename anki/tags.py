@@ -4,13 +4,19 @@
 
 from anki.utils import intTime, ids2str, json
 from anki.hooks import runHook
-import re
 
 """
 Anki maintains a cache of used tags so it can quickly present a list of tags
 for autocomplete and in the browser. For efficiency, deletions are not
 tracked, so unused tags can only be removed from the list with a DB check.
 
+The tags of each note can also be indexed in the notetags table, so tag
+searches and bulk edits don't need to scan the notes table. The index is
+optional, and dropped before a full upload; if it's enabled but missing when
+the collection is opened, it's rebuilt. It records the collection's mod time
+when it was last updated, so if another client changes the collection, the
+index is rebuilt on the next open.
+
 This module manages the tag cache and tags for notes.
 """
 
@@ -21,6 +27,7 @@ class TagManager(object):
 
     def __init__(self, col):
         self.col = col
+        self._indexed = False
 
     def load(self, json_):
         self.tags = json.loads(json_)
@@ -80,31 +87,205 @@ class TagManager(object):
         # cache tag names
         self.register(newTags)
         # find notes missing the tags
+        if self._indexed:
+            res = self._bulkCandidates(ids, newTags, add)
+        else:
+            res = self._bulkScan(ids, newTags, add)
+        # update tags
         if add:
-            l = "tags not "
             fn = self.addToStr
         else:
-            l = "tags "
             fn = self.remFromStr
+        mod = intTime()
+        usn = self.col.usn()
+        # many notes share the same tags
+        cache = {}
+        def fix(t):
+            if t not in cache:
+                cache[t] = fn(tags, t)
+            return cache[t]
+        self.col.db.executemany(
+            "update notes set tags=?,mod=?,usn=? where id = ?",
+            [(fix(t), mod, usn, id) for id, t in res])
+        self._bulkIndex(res, newTags, add)
+
+    def bulkRem(self, ids, tags):
+        self.bulkAdd(ids, tags, False)
+
+    def _bulkCandidates(self, ids, newTags, add):
+        "Return (id, tags) of notes in IDS that bulkAdd() needs to change."
+        newTags = dict((t.lower(), t) for t in newTags).values()
+        tagged = self.col.db.list(
+            "select nid from notetags where tag in (%s)" % ",".join(
+                "?"*len(newTags)), *newTags)
+        if add:
+            # notes that don't have all the tags
+            counts = {}
+            for nid in tagged:
+                counts[nid] = counts.get(nid, 0) + 1
+            ids = [id for id in ids if counts.get(id, 0) < len(newTags)]
+        else:
+            # notes that have any of them
+            tagged = set(tagged)
+            ids = [id for id in ids if id in tagged]
+        if not ids:
+            return []
+        return self.col.db.all(
+            "select id, tags from notes where id in " + ids2str(ids))
+
+    def _bulkScan(self, ids, newTags, add):
+        if add:
+            l = "tags not "
+        else:
+            l = "tags "
         lim = " or ".join(
             [l+"like :_%d" % c for c, t in enumerate(newTags)])
-        res = self.col.db.all(
+        return self.col.db.all(
             "select id, tags from notes where id in %s and (%s)" % (
                 ids2str(ids), lim),
             **dict([("_%d" % x, '%% %s %%' % y)
                     for x, y in enumerate(newTags)]))
-        # update tags
-        nids = []
-        def fix(row):
-            nids.append(row[0])
-            return {'id': row[0], 't': fn(tags, row[1]), 'n':intTime(),
-                'u':self.col.usn()}
+
+    # Tag index
+    ##########################################################################
+    # changing the schema commits the current transaction, so the index is
+    # only created or dropped when the collection is opened, when it's
+    # enabled or disabled, and before a full upload.
+
+    def loadIndex(self):
+        self._indexed = bool(self.col.db.scalar(
+            "select 1 from sqlite_master where name = 'notetags'"))
+
+    def openIndex(self):
+        "Create or drop the index to match the setting, and bring it up to date."
+        if self.col.server:
+            return
+        if not self.col.conf.get("tagIndex"):
+            if self._indexed:
+                # disabled on another client
+                self._dropIndex()
+            return
+        if not self._indexed:
+            self._createIndex()
+        elif self.col.db.scalar(
+            "select mod from notetagsmod") == self.col.mod:
+            return
+        # the index isn't a change to the collection, so commit it without
+        # marking the collection modified
+        mod = self.col.db.mod
+        self.rebuildIndex()
+        self.col.db.commit()
+        self.col.db.mod = mod
+
+    def enableIndex(self):
+        "Build the index, and use it from now on."
+        if self._indexed:
+            return
+        self.col.save()
+        self._createIndex()
+        self.rebuildIndex()
+        self.col.conf['tagIndex'] = True
+        self.col.setMod()
+
+    def disableIndex(self):
+        "Drop the index."
+        self.col.save()
+        self._dropIndex()
+        self.col.conf['tagIndex'] = False
+        self.col.setMod()
+
+    def _createIndex(self):
+        self.col.db.executescript("""
+create table notetags (
+    tag text not null collate nocase,
+    nid integer not null,
+    unique (tag, nid)
+);
+create index ix_notetags_nid on notetags (nid);
+create table notetagsmod (mod integer not null);
+insert into notetagsmod values (0);""")
+        self._indexed = True
+
+    def _dropIndex(self):
+        self.col.db.execute("drop table if exists notetags")
+        self.col.db.execute("drop table if exists notetagsmod")
+        self._indexed = False
+
+    def stampIndex(self):
+        "Note the index is up to date as of the collection's mod time."
+        if self._indexed:
+            self.col.db.execute(
+                "update notetagsmod set mod = ?", self.col.mod)
+
+    def indexed(self):
+        return self._indexed
+
+    def rebuildIndex(self):
+        "Reindex the tags of all notes."
+        if not self._indexed:
+            return
+        self.col.db.execute("delete from notetags")
+        lastId = 0
+        while 1:
+            rows = self.col.db.all(
+                "select id, tags from notes where id > ? and tags != '' "
+                "order by id limit 10000", lastId)
+            if not rows:
+                break
+            self._insertIndex(rows)
+            lastId = rows[-1][0]
+        self.stampIndex()
+
+    def updateIndex(self, nids):
+        "Reindex NIDS, after their tags have changed."
+        if not self._indexed or not nids:
+            return
+        snids = ids2str(nids)
+        self.col.db.execute("delete from notetags where nid in " + snids)
+        self._insertIndex(self.col.db.all(
+            "select id, tags from notes where id in %s and tags != ''" % snids))
+
+    def _bulkIndex(self, res, newTags, add):
+        "Update the index after bulkAdd() changed RES."
+        if not self._indexed or not res:
+            return
+        sids = ids2str([id for id, t in res])
+        if add:
+            for tag in self.canonify(newTags):
+                self.col.db.execute(
+                    "insert or ignore into notetags select ?, id from notes "
+                    "where id in " + sids, tag)
+            # canonify() also strips quotes from the existing tags
+            self.updateIndex(
+                [id for id, t in res if '"' in t or "'" in t])
+        else:
+            self.col.db.execute(
+                "delete from notetags where tag in (%s) and nid in %s" % (
+                    ",".join("?"*len(newTags)), sids), *newTags)
+
+    def removeIndex(self, nids):
+        if not self._indexed:
+            return
+        self.col.db.execute(
+            "delete from notetags where nid in " + ids2str(nids))
+
+    def _insertIndex(self, rows):
+        # tags differing only in case share an entry
         self.col.db.executemany(
-            "update notes set tags=:t,mod=:n,usn=:u where id = :id",
-            [fix(row) for row in res])
+            "insert or ignore into notetags values (?, ?)",
+            [(tag, nid) for nid, tags in rows for tag in self.split(tags)])
 
-    def bulkRem(self, ids, tags):
-        self.bulkAdd(ids, tags, False)
+    def search(self, val, args):
+        "SQL matching notes tagged VAL, or None if not indexed."
+        if not self._indexed:
+            return None
+        if val == "none":
+            return "n.id not in (select nid from notetags)"
+        val = val.replace("*", "%")
+        args.append(val)
+        if "%" in val or "_" in val:
+            return "n.id in (select nid from notetags where tag like ?)"
+        return "n.id in (select nid from notetags where tag = ?)"
 
     # String-based utilities
     ##########################################################################
@@ -146,7 +327,7 @@ class TagManager(object):
 
     def canonify(self, tagList):
         "Strip duplicates and sort."
-        strippedTags = [re.sub("[\"']", "", x) for x in tagList]
+        strippedTags = [x.replace('"', "").replace("'", "") for x in tagList]
         return sorted(set(strippedTags))
 
     def inList(self, tag, tags):
@@ -160,3 +341,5 @@ class TagManager(object):
         for k in self.tags.keys():
             self.tags[k] = 0
         self.save()
+        # other clients wouldn't keep it up to date
+        self._dropIndex()
@@ -1,7 +1,7 @@
-from anki.template.template import Template
+from anki.template.template import Template, CompiledTemplate
 from anki.template.view import View
 
 def render(template, context=None, **kwargs):
     context = context and context.copy() or {}
     context.update(kwargs)
-    return Template(template, context).render()
+    return CompiledTemplate(template).render(context)
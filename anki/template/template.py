@@ -220,3 +220,177 @@ class Template(object):
             return
         self.compile_regexps()
         return ''
+
+
+class CompiledTemplate(object):
+    """A template parsed once into a list of nodes, so it can be rendered for
+    many contexts in a single pass.
+
+    Rendering gives the same result as Template, which substitutes into the
+    template text and then rescans it. Templates and field contents where that
+    rescanning could make a difference (changed delimiters, unbalanced
+    sections, field text containing tags) are handed to Template instead."""
+
+    # passed to modifiers; it has the default delimiters, as templates which
+    # change them aren't compiled
+    template = Template("")
+    section_re = template.section_re
+    tag_re = template.tag_re
+
+    def __init__(self, template):
+        self.source = template
+        self._simple = True
+        self._tagText = {}
+        self.nodes = self._parse(template)
+        for tag, count in self._tagText.items():
+            if template.count(tag) != count:
+                # also part of some other text, which Template would replace
+                self._simple = False
+        if not self._simple:
+            self.nodes = None
+
+    def render(self, context):
+        if self.nodes is not None:
+            out = []
+            try:
+                if self._render(self.nodes, context, out):
+                    return "".join(out)
+            except (SyntaxError, KeyError):
+                pass
+        return Template(self.source, context).render()
+
+    # Parsing
+    ######################################################################
+
+    def _parse(self, text):
+        nodes = []
+        while 1:
+            match = self.section_re.search(text)
+            if match is None:
+                break
+            self._parseTags(text[:match.start()], nodes)
+            section, section_name, inner = match.group(0, 1, 2)
+            section_name = section_name.strip()
+            m = re.match("c[qa]:(\d+):(.+)", section_name)
+            nodes.append((section_name, m and m.groups(), section[2] == '^',
+                          self._parse(inner)))
+            text = text[match.end():]
+        self._parseTags(text, nodes)
+        return nodes
+
+    def _parseTags(self, text, nodes):
+        if re.search(r"\{\{[#|^]", text):
+            # section without an end
+            self._simple = False
+        pos = 0
+        for match in self.tag_re.finditer(text):
+            self._parseText(text[pos:match.start()], nodes)
+            pos = match.end()
+            tag, tag_type, tag_name = match.group(0, 1, 2)
+            tag_name = tag_name.strip()
+            if tag_type not in modifiers or tag_type == '=':
+                self._simple = False
+            else:
+                nodes.append((modifiers[tag_type], tag_name))
+                self._tagText[tag] = self._tagText.get(tag, 0) + 1
+        self._parseText(text[pos:], nodes)
+
+    def _parseText(self, text, nodes):
+        if not text:
+            return
+        if "{{" in text or text.startswith("}") or text.endswith("{"):
+            # could become part of a tag next to it
+            self._simple = False
+        nodes.append(text)
+
+    # Static analysis
+    ######################################################################
+
+    def analyse(self, fields, consts):
+        """Return [(conditions, text, field)] for everything the template can
+        show, in order, when FIELDS hold text without clozes and CONSTS hold
+        fields with a fixed value. Each item is shown if the (field, non-empty)
+        CONDITIONS all hold, and is either TEXT, or FIELD's content."""
+        items = []
+        self._analyse(self.nodes, set(fields), consts, (), items)
+        return items
+
+    def _analyse(self, nodes, fields, consts, conds, items):
+        for node in nodes:
+            if node.__class__ is not tuple:
+                items.append((conds, node, None))
+            elif len(node) == 2:
+                text, field = self._analyseTag(node, fields, consts)
+                items.append((conds, text, field))
+            else:
+                section_name, cloze, inverted, inner = node
+                if cloze:
+                    it = False
+                elif section_name in consts:
+                    it = bool(stripHTMLMedia(consts[section_name]).strip())
+                elif section_name in fields:
+                    self._analyse(inner, fields, consts,
+                                  conds + ((section_name, not inverted),),
+                                  items)
+                    continue
+                else:
+                    it = False
+                if it != inverted:
+                    self._analyse(inner, fields, consts, conds, items)
+
+    def _analyseTag(self, node, fields, consts):
+        "Return (text, field) for a tag, as render_unescaped() would show it."
+        func, tag_name = node
+        if func is modifiers['!']:
+            return "", None
+        if tag_name in consts:
+            return consts[tag_name], None
+        if tag_name in fields:
+            return None, tag_name
+        parts = tag_name.split(':', 2)
+        if len(parts) == 1 or parts[0] == '':
+            return '{unknown field %s}' % tag_name, None
+        mod, tag = parts[0], parts[-1]
+        if mod == 'type':
+            return "[[%s]]" % tag_name, None
+        elif mod == 'cq' or mod == 'ca':
+            return "", None
+        elif tag in consts:
+            # fixed, so the modifier can be applied now
+            return func(self.template, tag_name, consts), None
+        elif tag in fields:
+            return None, tag
+        return "", None
+
+    # Rendering
+    ######################################################################
+
+    def _render(self, nodes, context, out):
+        "Append NODES rendered to OUT, or return False if unsupported."
+        for node in nodes:
+            if node.__class__ is not tuple:
+                out.append(node)
+            elif len(node) == 2:
+                txt = node[0](self.template, node[1], context)
+                if "{{" in txt or txt.startswith("}") or txt.endswith("{"):
+                    return False
+                out.append(txt)
+            else:
+                section_name, cloze, inverted, inner = node
+                if cloze:
+                    txt = get_or_attr(context, cloze[1], None)
+                    m = re.search(clozeReg%cloze[0], txt)
+                    if m:
+                        it = m.group(1)
+                    else:
+                        it = None
+                else:
+                    it = get_or_attr(context, section_name, None)
+                if isinstance(it, basestring):
+                    it = stripHTMLMedia(it).strip()
+                elif it is not None:
+                    return False
+                if bool(it) != inverted:
+                    if not self._render(inner, context, out):
+                        return False
+        return True
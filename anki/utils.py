@@ -150,6 +150,9 @@ reEnts = re.compile("&#?\w+;")
 reMedia = re.compile("<img[^>]+src=[\"']?([^\"'>]+)[\"']?[^>]*>")
 
 def stripHTML(s):
+    if "<" not in s and "&" not in s:
+        # most fields have no markup
+        return s
     s = reStyle.sub("", s)
     s = reScript.sub("", s)
     s = reTag.sub("", s)
@@ -158,7 +161,8 @@ def stripHTML(s):
 
 def stripHTMLMedia(s):
     "Strip HTML but keep media filenames"
-    s = reMedia.sub(" \\1 ", s)
+    if "<" in s:
+        s = reMedia.sub(" \\1 ", s)
     return stripHTML(s)
 
 def minimizeHTML(s):
@@ -15,11 +15,13 @@ import aqt.forms
 from anki.utils import fmtTimeSpan, ids2str, stripHTMLMedia, isWin, intTime, isMac
 from aqt.utils import saveGeom, restoreGeom, saveSplitter, restoreSplitter, \
     saveHeader, restoreHeader, saveState, restoreState, applyStyles, getTag, \
-    showInfo, askUser, tooltip, openHelp, showWarning, shortcut, getBase, mungeQA
+    showInfo, askUser, tooltip, openHelp, showWarning, shortcut, getBase, \
+    mungeQA, showText
 from anki.hooks import runHook, addHook, remHook
 from aqt.webview import AnkiWebView
 from aqt.toolbar import Toolbar
 from anki.consts import *
+from anki.errors import AnkiError
 from anki.sound import playFromText, clearAudioQueue
 
 COLOUR_SUSPENDED = "#FFFFB2"
@@ -45,9 +47,17 @@ class DataModel(QAbstractTableModel):
     def getCard(self, index):
         id = self.cards[index.row()]
         if not id in self.cardObjs:
-            self.cardObjs[id] = self.col.getCard(id)
+            self._loadCards(index.row())
         return self.cardObjs[id]
 
+    def _loadCards(self, row):
+        # the view asks for cards a row at a time, so fetch the rows that
+        # follow as well
+        ids = [id for id in self.cards[row:row+100]
+               if id not in self.cardObjs]
+        for c in self.col.getCards(ids, notes=True):
+            self.cardObjs[c.id] = c
+
     def refreshNote(self, note):
         refresh = False
         for c in note.cards():
@@ -122,7 +132,12 @@ class DataModel(QAbstractTableModel):
         # the db progress handler may cause a refresh, so we need to zero out
         # old data first
         self.cards = []
-        self.cards = self.col.findCards(txt, order=True)
+        try:
+            self.cards = self.col.findCards(txt, order=True)
+        except AnkiError, e:
+            if e.type != "searchTimeout":
+                raise
+            tooltip(_("The search took too long, and was cancelled."))
         #self.browser.mw.pm.profile['fullSearch'])
         #print "fetch cards in %dms" % ((time.time() - t)*1000)
         if reset:
@@ -417,6 +432,9 @@ class Browser(QMainWindow):
         # card info
         self.infoCut = QShortcut(QKeySequence("Ctrl+Shift+I"), self)
         c(self.infoCut, SIGNAL("activated()"), self.showCardInfo)
+        # search profile, for debugging
+        self.profileCut = QShortcut(QKeySequence("Ctrl+:"), self)
+        c(self.profileCut, SIGNAL("activated()"), self.onProfileSearch)
         # set deck
         self.changeDeckCut = QShortcut(QKeySequence("Ctrl+D"), self)
         c(self.changeDeckCut, SIGNAL("activated()"), self.setDeck)
@@ -552,6 +570,34 @@ class Browser(QMainWindow):
         elif self.mw.state == "review":
             self.focusCid(self.mw.reviewer.card.id)
 
+    def onProfileSearch(self):
+        "Show how the current search is run."
+        import anki.find
+        txt = unicode(self.form.searchEdit.lineEdit().text()).strip()
+        if txt == _("<type here to search; hit enter to show current deck>"):
+            txt = "deck:current"
+        p = anki.find.Finder(self.col).profile(txt, order=True)
+        ms = lambda secs: "%0.1fms" % (secs*1000)
+        t = ["Search: %s" % p['query'], ""]
+        if p['sql'] is None:
+            t.append("Invalid search.")
+        else:
+            t.append("SQL: %s" % p['sql'])
+            t.append("Args: %r" % (p['args'],))
+            t.append("")
+            t.append("Query plan:")
+            t.extend("  " + line for line in p['plan'])
+        t.append("")
+        t.append("Time: " + ", ".join(
+            "%s %s" % (k, ms(p['times'][k]))
+            for k in ("tokenize", "build", "run") if k in p['times']))
+        for term, secs in p['terms']:
+            t.append("  %s: %s" % (term, ms(secs)))
+        t.append("Cards: %d" % p['cards'])
+        t.append("Field matches: %d" % p['fieldCalls'])
+        t.append("SQLite instructions: %d" % p['steps'])
+        showText("\n".join(t), parent=self)
+
     def updateTitle(self):
         selected = len(self.form.tableView.selectionModel().selectedRows())
         cur = len(self.model.cards)
@@ -1207,9 +1253,14 @@ update cards set usn=?, mod=?, did=? where id in """ + scids,
             return
         self.model.beginReset()
         self.mw.checkpoint(_("Reposition"))
-        self.col.sched.sortCards(
-            cids, start=frm.start.value(), step=frm.step.value(),
-            shuffle=frm.randomize.isChecked(), shift=frm.shift.isChecked())
+        self.mw.progress.start(max=len(cids))
+        try:
+            self.col.sched.sortCards(
+                cids, start=frm.start.value(), step=frm.step.value(),
+                shuffle=frm.randomize.isChecked(), shift=frm.shift.isChecked(),
+                progress=self._bulkProgress)
+        finally:
+            self.mw.progress.finish()
         self.onSearch(reset=False)
         self.mw.requireReset()
         self.model.endReset()
@@ -1226,18 +1277,27 @@ update cards set usn=?, mod=?, did=? where id in """ + scids,
             return
         self.model.beginReset()
         self.mw.checkpoint(_("Reschedule"))
-        if frm.asNew.isChecked():
-            self.col.sched.forgetCards(self.selectedCards())
-        else:
-            fmin = frm.min.value()
-            fmax = frm.max.value()
-            fmax = max(fmin, fmax)
-            self.col.sched.reschedCards(
-                self.selectedCards(), fmin, fmax)
+        cids = self.selectedCards()
+        self.mw.progress.start(max=len(cids))
+        try:
+            if frm.asNew.isChecked():
+                self.col.sched.forgetCards(cids, progress=self._bulkProgress)
+            else:
+                fmin = frm.min.value()
+                fmax = frm.max.value()
+                fmax = max(fmin, fmax)
+                self.col.sched.reschedCards(
+                    cids, fmin, fmax, progress=self._bulkProgress)
+        finally:
+            self.mw.progress.finish()
         self.onSearch(reset=False)
         self.mw.requireReset()
         self.model.endReset()
 
+    def _bulkProgress(self, done, total):
+        self.mw.progress.update(value=done)
+        return self.mw.progress.wantCancel()
+
     # Edit: selection
     ######################################################################
 
@@ -1303,7 +1363,7 @@ update cards set usn=?, mod=?, did=? where id in """ + scids,
         else:
             field = fields[frm.field.currentIndex()-1]
         self.mw.checkpoint(_("Find and Replace"))
-        self.mw.progress.start()
+        self.mw.progress.start(max=len(sf), cancellable=True)
         self.model.beginReset()
         try:
             changed = self.col.findReplace(sf,
@@ -1311,7 +1371,8 @@ update cards set usn=?, mod=?, did=? where id in """ + scids,
                                             unicode(frm.replace.text()),
                                             frm.re.isChecked(),
                                             field,
-                                            frm.ignoreCase.isChecked())
+                                            frm.ignoreCase.isChecked(),
+                                            progress=self._bulkProgress)
         except sre_constants.error:
             showInfo(_("Invalid regular expression."), parent=self)
             return
@@ -1361,7 +1422,11 @@ update cards set usn=?, mod=?, did=? where id in """ + scids,
 
     def duplicatesReport(self, web, fname, search, frm):
         self.mw.progress.start()
-        res = self.mw.col.findDupes(fname, search)
+        res = []
+        for group in self.mw.col.iterDupes(fname, search):
+            res.append(group)
+            if len(res) % 1000 == 0:
+                self.mw.progress.update()
         if not self._dupesButton:
             self._dupesButton = b = frm.buttonBox.addButton(
                 _("Tag Duplicates"), QDialogButtonBox.ActionRole)
@@ -45,7 +45,7 @@ class Overview(object):
             deck = self.mw.col.decks.current()
             self.mw.onCram("'deck:%s'" % deck['name'])
         elif url == "refresh":
-            self.mw.col.sched.rebuildDyn()
+            self.mw.col.sched.rebuildDyn(incremental=True)
             self.mw.reset()
         elif url == "empty":
             self.mw.col.sched.emptyDyn(self.mw.col.decks.selected())
@@ -68,7 +68,7 @@ class Overview(object):
         if key == "o":
             self.mw.onDeckConf()
         if key == "r" and cram:
-            self.mw.col.sched.rebuildDyn()
+            self.mw.col.sched.rebuildDyn(incremental=True)
             self.mw.reset()
         if key == "e" and cram:
             self.mw.col.sched.emptyDyn(self.mw.col.decks.selected())
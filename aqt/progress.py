@@ -21,6 +21,7 @@ class ProgressManager(object):
         self.blockUpdates = False
         self._win = None
         self._levels = 0
+        self._cancellable = False
 
     # SQLite progress handler
     ##########################################################################
@@ -84,16 +85,21 @@ Your pysqlite2 is too old. Anki will appear frozen during long operations."""
             if evt.key() == Qt.Key_Escape:
                 evt.ignore()
 
-    def start(self, max=0, min=0, label=None, parent=None, immediate=False):
+    def start(self, max=0, min=0, label=None, parent=None, immediate=False,
+              cancellable=False):
         self._levels += 1
         if self._levels > 1:
             return
         # setup window
         parent = parent or self.app.activeWindow() or self.mw
         label = label or _("Processing...")
-        self._win = self.ProgressNoCancel(label, "", min, max, parent)
+        self._cancellable = cancellable
+        if cancellable:
+            self._win = QProgressDialog(label, _("Cancel"), min, max, parent)
+        else:
+            self._win = self.ProgressNoCancel(label, "", min, max, parent)
+            self._win.setCancelButton(None)
         self._win.setWindowTitle("Anki")
-        self._win.setCancelButton(None)
         self._win.setAutoClose(False)
         self._win.setAutoReset(False)
         self._win.setWindowModality(Qt.ApplicationModal)
@@ -124,7 +130,17 @@ Your pysqlite2 is too old. Anki will appear frozen during long operations."""
             self._counter = value or (self._counter+1)
             self._win.setValue(self._counter)
         if process:
-            self.app.processEvents(QEventLoop.ExcludeUserInputEvents)
+            if self._cancellable:
+                # so the cancel button can be pressed; the dialog is modal,
+                # so nothing else can be
+                self.app.processEvents()
+            else:
+                self.app.processEvents(QEventLoop.ExcludeUserInputEvents)
+
+    def wantCancel(self):
+        "True if the user has cancelled the current operation."
+        return bool(self._levels and self._cancellable and
+                    self._win.wasCanceled())
 
     def finish(self):
         self._levels -= 1
@@ -212,6 +212,12 @@ The front of this card is empty. Please run Tools>Empty Cards.""")
             self.mw.web.setFocus()
         # user hook
         runHook('showQuestion')
+        # prepare the following cards while the user is thinking
+        self.mw.progress.timer(100, self._prefetch, False)
+
+    def _prefetch(self):
+        if self.mw.state == "review" and self.mw.col:
+            self.mw.col.sched.prefetch()
 
     def autoplay(self, card):
         return self.mw.col.decks.confForDid(
@@ -75,6 +75,29 @@ def test_genrem():
     f.flush()
     assert len(f.cards()) == 2
 
+def test_genBatches():
+    d = getEmptyDeck()
+    m = d.models.byName("Basic (and reversed card)")
+    d.models.setCurrent(m)
+    nids = []
+    for i in range(5):
+        f = d.newNote()
+        f['Front'] = u'f%d' % i
+        f['Back'] = u'b%d' % i
+        d.addNote(f)
+        nids.append(f.id)
+    # remove the reverse cards, and generate them again in small chunks
+    d.remCards(d.db.list("select id from cards where ord = 1"), notes=False)
+    pos = d.conf['nextPos']
+    assert d.genCards(nids, chunk=2) == []
+    assert d.db.list("select due from cards where ord = 1 order by id") == \
+        range(pos, pos+5)
+    assert d.conf['nextPos'] == pos+5
+    # cards that are no longer needed are returned
+    d.db.execute("update notes set flds = ? where id = ?",
+                 u"f0\x1f", nids[0])
+    assert len(d.genCards(nids, chunk=2)) == 1
+
 def test_gendeck():
     d = getEmptyDeck()
     cloze = d.models.byName("Cloze")
@@ -107,3 +130,84 @@ def test_gendeck():
 
 
 
+
+def test_qaCache():
+    import os, tempfile
+    d = getEmptyDeck()
+    f = d.newNote()
+    f['Front'] = u'1'
+    f['Back'] = u'2'
+    d.addNote(f)
+    cid = f.cards()[0].id
+    renders = []
+    render = d._renderQA
+    def countRenders(*args):
+        renders.append(args[0][0])
+        return render(*args)
+    d._renderQA = countRenders
+    assert d.getCard(cid).q().endswith("1")
+    # a new card object doesn't render again
+    assert d.getCard(cid).q().endswith("1")
+    assert len(renders) == 1
+    # unless asked to
+    d.getCard(cid).q(reload=True)
+    assert len(renders) == 2
+    # changes to the note, even in the same second, are noticed
+    f['Front'] = u'3'
+    f.flush()
+    assert not d.qaCache.entries
+    assert d.getCard(cid).q().endswith("3")
+    d.db.execute("update notes set flds = ?", u"4\x1f2")
+    assert d.getCard(cid).q().endswith("4")
+    # as are changes to the model and deck
+    m = d.models.current()
+    m['tmpls'][0]['qfmt'] = "{{Deck}}"
+    d.models.save(m)
+    assert d.getCard(cid).q().endswith("Default")
+    d.decks.rename(d.decks.get(1), "new")
+    assert d.getCard(cid).q().endswith("new")
+    n = len(renders)
+    # entries can be kept on disk
+    (fd, path) = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    os.unlink(path)
+    d.qaCache.persist(path)
+    d.close()
+    d.reopen()
+    d.load()
+    d.qaCache.invalidate()
+    d.qaCache.persist(path)
+    assert d.getCard(cid).q().endswith("new")
+    assert len(renders) == n
+    os.unlink(path)
+
+def test_getCards():
+    d = getEmptyDeck()
+    m = d.models.byName("Basic (and reversed card)")
+    d.models.setCurrent(m)
+    notes = []
+    for i in range(5):
+        f = d.newNote()
+        f['Front'] = u"front%d" % i; f['Back'] = u"back%d" % i
+        notes.append(f)
+    d.addNotes(notes)
+    cids = d.db.list("select id from cards order by id desc")
+    # loaded in the order asked for, a few at a time
+    cards = d.getCards(cids + [12345], chunk=3)
+    assert [c.id for c in cards] == cids
+    for c in cards:
+        c2 = d.getCard(c.id)
+        assert c.__dict__ == c2.__dict__
+    # notes can be loaded with them, and are shared by siblings
+    cards = d.getCards(cids, notes=True)
+    assert cards[0]._note is cards[1]._note
+    assert cards[0].note()['Front'] == u"front4"
+    assert "back4" in cards[0].q()
+    assert "front4" in cards[1].q()
+    nids = [f.id for f in notes]
+    loaded = d.getNotes(list(reversed(nids)), chunk=2)
+    assert [n.id for n in loaded] == list(reversed(nids))
+    assert loaded[0].fields == notes[-1].fields
+    assert loaded[0].tags == notes[-1].tags
+    assert [c.id for c in notes[0].cards()] == [
+        c.id for c in d.getCards(sorted(cids)[:2])]
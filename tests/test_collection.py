@@ -78,6 +78,41 @@ def test_noteAddDelete():
     f2['Front'] = " "
     assert f2.dupeOrEmpty()
 
+def test_addNotes():
+    deck = getEmptyDeck()
+    m = deck.models.current(); mm = deck.models
+    t = mm.newTemplate("Reverse")
+    t['qfmt'] = "{{Back}}"
+    t['afmt'] = "{{Front}}"
+    mm.addTemplate(m, t)
+    mm.save(m)
+    notes = []
+    for front, back in ((u"one", u"two"), (u"", u""), (u"three", u"")):
+        f = deck.newNote()
+        f['Front'] = front; f['Back'] = back
+        f.tags = [u"bulk"]
+        notes.append(f)
+    nids = deck.addNotes(notes)
+    # the empty note is skipped
+    assert nids == [notes[0].id, notes[2].id]
+    assert deck.noteCount() == 2
+    assert deck.cardCount() == 3
+    assert len(notes[0].cards()) == 2
+    assert len(notes[2].cards()) == 1
+    # positions are allocated in order, shared by siblings
+    dues = [c.due for c in notes[0].cards()]
+    assert dues[0] == dues[1]
+    assert notes[2].cards()[0].due == dues[0] + 1
+    assert deck.conf['nextPos'] == dues[0] + 2
+    # notes are stored as addNote() would store them
+    f = deck.getNote(nids[0])
+    assert f['Front'] == u"one" and f.tags == [u"bulk"]
+    assert "bulk" in deck.tags.all()
+    assert len(deck.findNotes("tag:bulk")) == 2
+    assert deck.findNotes("three") == [nids[1]]
+    assert "two" in notes[0].cards()[1].q()
+    assert deck.addNotes([]) == []
+
 def test_fieldChecksum():
     deck = getEmptyDeck()
     f = deck.newNote()
@@ -137,3 +172,23 @@ def test_furigana():
     m['tmpls'][0]['qfmt'] = '{{kana:}}'
     mm.save(m)
     c.q(reload=True)
+
+def test_renderQA():
+    deck = getEmptyDeck()
+    m = deck.models.byName("Basic (and reversed card)")
+    deck.models.setCurrent(m)
+    for i in range(5):
+        n = deck.newNote()
+        n['Front'] = u"f%d" % i
+        n['Back'] = u"b%d" % i
+        deck.addNote(n)
+    cids = deck.db.list("select id from cards order by id")
+    nids = deck.db.list("select id from notes")
+    qa = deck.renderQA(cids)
+    assert [x['id'] for x in qa] == cids
+    assert qa == [deck.getCard(id)._getQA() for id in cids]
+    # other types and chunk sizes give the same results
+    assert deck.renderQA(nids, type="note") == qa
+    assert deck.renderQA([m['id']], type="model") == qa
+    assert list(deck.iterRenderQA(type="all", chunk=3)) == qa
+    assert list(deck.iterRenderQA(reversed(cids), chunk=4)) == qa
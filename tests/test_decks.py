@@ -88,6 +88,30 @@ def test_rename():
     for n in "yo", "yo::two", "yo::two::three":
         assert n in d.decks.allNames()
 
+def test_index():
+    d = getEmptyDeck()
+    one = d.decks.id("one::two::three")
+    two = d.decks.id("one::two")
+    top = d.decks.id("one")
+    assert d.decks.id("ONE::TWO") == two
+    assert d.decks.byName("one::two")['id'] == two
+    assert sorted(d.decks.children(top)) == [
+        ("one::two", two), ("one::two::three", one)]
+    assert [p['id'] for p in d.decks.parents(one)] == [top, two]
+    # renames and removals should be reflected
+    d.decks.rename(d.decks.get(two), "foo")
+    assert d.decks.children(top) == []
+    assert d.decks.children(two) == [("foo::three", one)]
+    assert d.decks.id("one::two", create=False) is None
+    assert d.decks.byName("foo::three")['id'] == one
+    d.decks.rem(two)
+    assert d.decks.id("foo::three", create=False) is None
+    # as should decks renamed directly
+    g = d.decks.get(top)
+    g['name'] = "bar"
+    d.decks.save(g)
+    assert d.decks.id("bar", create=False) == top
+
 def test_renameForDragAndDrop():
     d = getEmptyDeck()
 
@@ -34,6 +34,7 @@ def test_export_anki():
     conf['new']['perDay'] = 5
     deck.decks.save(conf)
     deck.decks.setConf(dobj, confId)
+    deck.tags.enableIndex()
     # export
     e = AnkiExporter(deck)
     newname = unicode(tempfile.mkstemp(prefix="ankitest", suffix=".anki2")[1])
@@ -45,6 +46,9 @@ def test_export_anki():
     # connect to new deck
     d2 = aopen(newname)
     assert d2.cardCount() == 2
+    # the tag index is local, so it's not exported
+    assert not d2.tags.indexed()
+    assert len(d2.findCards("tag:tag2")) == 1
     # as scheduling was reset, should also revert decks to default conf
     did = d2.decks.id("test", create=False)
     assert did
@@ -103,14 +107,14 @@ def test_export_anki_due():
     deck2.sched.reset()
     assert c.due - deck2.sched.today == 1
 
-# @nose.with_setup(setup1)
-# def test_export_textcard():
-#     e = TextCardExporter(deck)
-#     f = unicode(tempfile.mkstemp(prefix="ankitest")[1])
-#     os.unlink(f)
-#     e.exportInto(f)
-#     e.includeTags = True
-#     e.exportInto(f)
+@nose.with_setup(setup1)
+def test_export_textcard():
+    e = TextCardExporter(deck)
+    f = unicode(tempfile.mkstemp(prefix="ankitest")[1])
+    os.unlink(f)
+    e.exportInto(f)
+    assert open(f).read() == "foo\tbar\nbaz\tqux\n"
+    os.unlink(f)
 
 @nose.with_setup(setup1)
 def test_export_textnote():
@@ -1,7 +1,12 @@
 # coding: utf-8
 
-from anki.find import Finder
-from tests.shared import getEmptyDeck
+import sqlite3
+
+import anki.find
+from anki import Collection as aopen
+from anki.find import Finder, iterDupes
+from anki.errors import AnkiError
+from tests.shared import assertException, getEmptyDeck
 
 def test_parse():
     f = Finder(None)
@@ -215,6 +220,315 @@ def test_findCards():
     assert len(deck.findCards("added:1")) == deck.cardCount() - 1
     assert len(deck.findCards("added:2")) == deck.cardCount()
 
+def test_compile():
+    deck = getEmptyDeck()
+    for i in range(3):
+        f = deck.newNote()
+        f['Front'] = u"%d" % i
+        f['Back'] = u"foo"
+        deck.addNote(f)
+    cids = deck.db.list("select id from cards order by id")
+    # the same search is only parsed once
+    q = Finder(deck).compile("deck:default")
+    assert Finder(deck).compile("deck:default") is q
+    assert q.findCards(order="c.id") == cids
+    assert q.findCards(order="c.id desc", limit=2) == list(reversed(cids))[:2]
+    assert deck.findCards("deck:default", order="c.id", limit=1) == cids[:1]
+    deck.conf['sortType'] = "cardMod"
+    deck.conf['sortBackwards'] = True
+    assert len(q.findCards(order=True, limit=2)) == 2
+    # renaming the deck invalidates it
+    deck.decks.rename(deck.decks.get(1), "foo")
+    assert Finder(deck).compile("deck:default") is not q
+    assert deck.findCards("deck:default") == []
+    assert len(deck.findCards("deck:foo")) == 3
+    # as does adding a deck that matches a wildcard
+    assert deck.findCards("deck:foo::b*") == []
+    did = deck.decks.id("foo::bar")
+    deck.db.execute("update cards set did = ? where id = ?", did, cids[0])
+    assert deck.findCards("deck:foo::b*") == [cids[0]]
+    # field searches are matched in SQL, so note changes don't affect them
+    q = Finder(deck).compile("front:1")
+    assert q.findCards() == [cids[1]]
+    n = deck.getCard(cids[2]).note()
+    n['Front'] = u"1"
+    n.flush()
+    assert Finder(deck).compile("front:1") is q
+    assert len(deck.findCards("front:1")) == 2
+    # but dupe searches read the notes when compiled
+    q = Finder(deck).compile("dupe:%s,1" % n.mid)
+    assert Finder(deck).compile("dupe:%s,1" % n.mid) is q
+    n.flush(mod=1)
+    assert Finder(deck).compile("dupe:%s,1" % n.mid) is not q
+    # model changes invalidate searches by model or field name
+    m = deck.models.current()
+    assert len(deck.findCards("note:basic")) == 3
+    m['name'] = u"renamed"
+    deck.models.save(m)
+    assert len(deck.findCards("note:basic")) == 0
+
+def test_findPages():
+    deck = getEmptyDeck()
+    m = deck.models.byName("Basic (and reversed card)")
+    deck.models.setCurrent(m)
+    for i, front in enumerate(u"cabbage apple Banana apple cherry".split()):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = u"x"
+        deck.addNote(f)
+        # some cards share a sort key
+        deck.db.execute("update cards set mod = ?, reps = ? where nid = ?",
+                        i % 2, i, f.id)
+    def pages(order, limit):
+        ids, after = deck.findCardsPage("", order, limit)
+        while after is not None:
+            more, after = deck.findCardsPage("", order, limit, after)
+            ids.extend(more)
+        return ids
+    # pages and iteration follow the full search's order, in both directions
+    for type in ("noteCrt", "noteFld", "cardMod", "cardReps", "cardDue"):
+        deck.conf['sortType'] = type
+        results = []
+        for back in (False, True):
+            deck.conf['sortBackwards'] = back
+            ids = deck.findCards("", order=True)
+            assert len(ids) == 10
+            for limit in (1, 3, 10):
+                assert pages(True, limit) == ids
+            assert list(deck.iterCards("", order=True, chunk=4)) == ids
+            results.append(ids)
+        assert results[0] == list(reversed(results[1]))
+    ids = sorted(deck.findCards(""))
+    assert pages(False, 3) == ids
+    assert pages("c.id desc", 3) == list(reversed(ids))
+    assert deck.findCardsPage("apple", limit=2) == (ids[2:4], tuple(ids[3:4]))
+    assert deck.countCards("") == 10
+    assert deck.countCards("apple") == 4
+    assert list(deck.iterNotes("", chunk=2)) == sorted(deck.findNotes(""))
+    assert list(deck.iterCards("nothing")) == []
+
+def test_regex():
+    deck = getEmptyDeck()
+    for front, back in ((u"cat", u"dog"), (u"Cab", u"cat food"),
+                        (u"über", u"a(b)")):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    assert len(deck.findCards("re:^ca.$")) == 2
+    assert len(deck.findCards("re:^cat")) == 2
+    assert len(deck.findCards("front:re:^cat")) == 1
+    assert len(deck.findCards("back:re:^cat")) == 1
+    assert len(deck.findCards("-re:^cat")) == 1
+    assert len(deck.findCards(u"re:^Ü")) == 1
+    assert len(deck.findCards(u"re:^\\w+$ -re:o")) == 1
+    assert len(deck.findCards('"re:a\\(b\\)"')) == 1
+    # invalid or dangerous patterns match nothing
+    assert deck.findCards("re:[") == []
+    assert deck.findCards('"re:(a+)+$"') == []
+    assert deck.findCards('"front:re:(.*a){2,}"') == []
+    assert deck.findCards('"re:^(a|a)*b"') == []
+    assert deck.findCards('"re:^(?:c|x)+at"') == []
+    # as are overlapping unbounded repeats, which can take polynomial time
+    assert deck.findCards('"re:.*.*.*.*x"') == []
+    assert deck.findCards('"re:c.*a.*t"') == []
+    assert deck.findCards('"re:ca{2,}t{0,200}"') == []
+    assert len(deck.findCards('"re:c.*t"')) == 2
+    # but grouping, optional groups and brackets in classes are fine
+    assert len(deck.findCards('"re:^(ca|xx)t"')) == 2
+    assert len(deck.findCards('"re:^c(a|x)?t"')) == 2
+    assert len(deck.findCards('"re:^[(c+)]+at"')) == 2
+    # slow searches are interrupted
+    nid = f.id
+    deck.db.executemany(
+        "insert into notes select id+?, guid||?, mid, mod, usn, tags, flds, "
+        "sfld, csum, flags, data from notes where id = ?",
+        [(i, str(i), nid) for i in range(1, 20001)])
+    deck.db.execute(
+        "insert into cards select c.id+n.id-?, n.id, did, ord, c.mod, c.usn, "
+        "type, queue, due, ivl, factor, reps, lapses, left, odue, odid, "
+        "c.flags, c.data from cards c, notes n where c.nid = ? and n.id > ?",
+        nid, nid, nid)
+    assert len(deck.findCards(u"re:über")) == 20001
+    Finder.regexTimeout = 0
+    try:
+        assertException(AnkiError, lambda: deck.findCards("re:nothing"))
+        # other searches aren't affected
+        assert len(deck.findCards("front:*ber")) == 20001
+    finally:
+        Finder.regexTimeout = 10
+
+def test_profile():
+    deck = getEmptyDeck()
+    for front in u"dog", u"cat", u"goat":
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = u"x"
+        deck.addNote(f)
+    calls = []
+    deck.db.set_progress_handler(lambda: calls.append(1), 1)
+    p = Finder(deck).profile("front:*o* -tag:foo deck:default")
+    assert p['cards'] == 2
+    assert "fieldmatch" in p['sql']
+    assert p['args']
+    assert p['plan']
+    assert [t for t, secs in p['terms']] == [
+        "front:*o*", "tag:foo", "deck:default"]
+    assert sorted(p['times'].keys()) == ["build", "run", "tokenize"]
+    assert p['fieldCalls'] == 2
+    assert p['steps'] > 0
+    # the previous progress handler is restored
+    del calls[:]
+    deck.findCards("dog")
+    assert calls
+    # invalid searches have no sql
+    assert Finder(deck).profile("deck:missing")['sql'] is None
+
+def test_textIndex():
+    deck = getEmptyDeck()
+    if not deck.fts.available():
+        print "aborting test; sqlite has no fts5 trigram support"
+        return
+    for front, back in ((u"dog", u"cat"), (u"goats are fun", u"sheep"),
+                        (u"Cat", u"<b>concatenate</b>"), (u"a_b", u"50%")):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    searches = ["cat", "CAT", "goats", '"goats are"', "c*t", "at",
+                "sheep -cat", "a_b", "a\\_b", "50\\%", "nothing"]
+    expected = [sorted(deck.findCards(s)) for s in searches]
+    deck.fts.enable()
+    assert deck.fts.size()[0] == 4
+    assert [sorted(deck.findCards(s)) for s in searches] == expected
+    # markup is ignored
+    assert deck.findCards("<b>") == []
+    # edits, replacements and deletions are reflected
+    f = deck.getCard(deck.findCards("dog")[0]).note()
+    f['Front'] = u"wolf"
+    f.flush()
+    assert deck.findCards("dog") == []
+    assert deck.findCards("wolf") == [f.cards()[0].id]
+    deck.findReplace([f.id], "wolf", "fox")
+    assert deck.findCards("wolf") == []
+    assert len(deck.findCards("fox")) == 1
+    deck.remNotes([f.id])
+    assert deck.findCards("fox") == []
+    assert deck.fts.size()[0] == 3
+    # reopening with a missing index builds it on demand
+    deck.fts.beforeUpload()
+    deck.save()
+    deck.fts.load()
+    assert deck.fts.enabled()
+    assert deck.fts.size()[0] == 0
+    # or on the next load, if it wasn't needed before then
+    deck.close()
+    deck = aopen(deck.path)
+    assert len(deck.findCards("sheep")) == 1
+    assert deck.fts.size()[0] == 3
+    # changes by a client that doesn't update the index are picked up
+    deck.close()
+    db = sqlite3.connect(deck.path)
+    db.execute("update notes set flds = 'lamb' || flds where flds like "
+               "'%sheep%'")
+    db.execute("update col set mod = mod + 1")
+    db.commit()
+    db.close()
+    deck = aopen(deck.path)
+    assert len(deck.findCards("lamb")) == 1
+    # clients without index support ignore the table and setting
+    deck.fts.available = lambda: False
+    deck.fts.load()
+    assert not deck.fts.enabled()
+    f = deck.getNote(deck.findNotes("lamb")[0])
+    f['Back'] = u"goat"
+    f.flush()
+    assert len(deck.findCards("goat")) == 1
+    del deck.fts.available
+    deck.fts.disable()
+    assert deck.fts.size() is None
+    assert len(deck.findCards("sheep")) == 0
+    deck.conf['textIndex'] = True
+    deck.fts.available = lambda: False
+    deck.fts.load()
+    assert not deck.fts.enabled()
+    assert len(deck.findCards("goat")) == 1
+
+def test_tagIndex():
+    deck = getEmptyDeck()
+    # the index is optional
+    assert not deck.tags.indexed()
+    deck.tags.enableIndex()
+    assert deck.tags.indexed()
+    for tags in ([u"animal", u"Dog"], [u"animal::cat"], [u"a_b", u"dogs"], [], []):
+        f = deck.newNote()
+        f['Front'] = u"x"
+        f.tags = tags
+        deck.addNote(f)
+    def index():
+        return sorted(deck.db.all("select nid, lower(tag) from notetags"))
+    def check():
+        # the index matches one rebuilt from scratch
+        idx = index()
+        deck.tags.rebuildIndex()
+        assert index() == idx
+    searches = ["tag:dog", "tag:DOG", "tag:dog*", "tag:animal",
+                "tag:animal::*", "tag:*cat", "tag:a_b", "tag:none",
+                "-tag:none", "tag:cat"]
+    nids = deck.db.list("select id from notes order by id")
+    deck.tags.bulkAdd(nids[2:4], u"new Dog")
+    deck.tags.bulkRem(nids[:2], u"animal")
+    check()
+    results = [sorted(deck.findCards(s)) for s in searches]
+    assert [len(x) for x in results] == [3, 3, 3, 0, 1, 1, 1, 1, 4, 0]
+    # searches and bulk edits match the behaviour without an index
+    deck.tags.beforeUpload()
+    assert not deck.tags.indexed()
+    assert [sorted(deck.findCards(s)) for s in searches] == results
+    deck.tags.bulkRem(nids, u"new")
+    deck.tags.bulkAdd(nids[:1], u"extra")
+    tags = deck.db.list("select tags from notes order by id")
+    deck.save()
+    # an enabled index is recreated when the collection is opened
+    deck.tags.openIndex()
+    assert deck.tags.indexed()
+    deck.tags.bulkAdd(nids[:1], u"new")
+    deck.tags.bulkRem(nids, u"new")
+    deck.tags.bulkAdd(nids[:1], u"extra")
+    assert deck.db.list("select tags from notes order by id") == tags
+    check()
+    # edits and deletions are reflected
+    f = deck.getNote(nids[0])
+    f.tags = [u"edited"]
+    f.flush()
+    assert len(deck.findCards("tag:edited")) == 1
+    deck.remNotes(nids[:2])
+    assert deck.findCards("tag:edited") == []
+    check()
+    # discarded changes don't touch it
+    deck.save()
+    deck.tags.bulkAdd(nids[2:3], u"discarded")
+    deck.rollback()
+    assert deck.findCards("tag:discarded") == []
+    check()
+    # changes by a client that doesn't update the index are picked up
+    # when the collection is next opened
+    deck.close()
+    db = sqlite3.connect(deck.path)
+    db.execute("update notes set tags = ' other ' where id = ?", (nids[2],))
+    db.execute("update col set mod = mod + 1")
+    db.commit()
+    db.close()
+    deck = aopen(deck.path)
+    assert len(deck.findCards("tag:other")) == 1
+    check()
+    # disabling it drops it
+    deck.tags.disableIndex()
+    assert not deck.tags.indexed()
+    assert not deck.db.scalar(
+        "select 1 from sqlite_master where name like 'notetags%'")
+    assert len(deck.findCards("tag:other")) == 1
+
 def test_findReplace():
     deck = getEmptyDeck()
     f = deck.newNote()
@@ -241,6 +555,26 @@ def test_findReplace():
     f.load(); assert f['Back'] != "reg"
     assert deck.findReplace(nids, "B.r", "reg", regex=True) == 1
     f.load(); assert f['Back'] == "reg"
+    # cards are generated when a field is filled in
+    deck.models.setCurrent(deck.models.byName("Basic (and reversed card)"))
+    f3 = deck.newNote()
+    f3['Front'] = u'one'
+    deck.addNote(f3)
+    assert len(f3.cards()) == 1
+    assert deck.findReplace([f3.id], "one", "two") == 1
+    assert len(f3.cards()) == 1
+    assert deck.findReplace([f3.id], "^$", "back", regex=True) == 1
+    assert len(f3.cards()) == 2
+    # progress is reported per chunk, and can stop the replacement
+    calls = []
+    def progress(done, total):
+        calls.append((done, total))
+    nids.append(f3.id)
+    assert anki.find.findReplace(deck, nids, "o", "0", progress=progress,
+                                 chunk=2) == 2
+    assert calls == [(2, 3), (3, 3)]
+    assert anki.find.findReplace(deck, nids, "0", "o", chunk=1,
+                                 progress=lambda d, t: True) == 1
 
 def test_findDupes():
     deck = getEmptyDeck()
@@ -272,3 +606,20 @@ def test_findDupes():
     assert not r
     # front isn't dupe
     assert deck.findDupes("Front") == []
+    # groups span note types with the field in different places
+    m = deck.models.copy(deck.models.current())
+    deck.models.moveField(m, m['flds'][1], 0)
+    deck.models.setCurrent(m)
+    for front, back in ((u"foo", u"bar"), (u"x", u"<b>nope</b>"),
+                        (u"x", u"&nbsp;nope"), (u"x", u"nope ")):
+        f = deck.newNote()
+        f['Front'] = front
+        f['Back'] = back
+        deck.addNote(f)
+    def dupes(field, search="", chunk=10000):
+        return sorted((v, len(ids)) for v, ids in
+                      iterDupes(deck, field, search, chunk))
+    assert dupes("Back") == sorted([(u"bar", 4), (u"nope", 2)])
+    assert dupes("Front") == [(u"foo", 2), (u"x", 3)]
+    assert dupes("Front", chunk=1) == dupes("Front")
+    assert dupes("Back", "-nope", chunk=1) == [(u"bar", 4)]
@@ -262,3 +262,68 @@ def test_availOrds():
     t['Front'] = ""
     t['Back'] = "1"
     assert mm.availOrds(m, joinFields(f.fields)) == [0]
+
+def test_compiledTemplate():
+    from anki.template import Template, CompiledTemplate
+    ctx = dict(Front=u"<b>f</b>", Back=u"", Text=u"a {{c1::b::hint}} c",
+               Tags=u"x", Loop=u"{{Front}}", Open=u"brace{")
+    for t in (u"{{Front}}", u"{{#Front}}[{{Front}}]{{/Front}}{{^Back}}-{{/Back}}",
+              u"{{#Back}}{{Back}}{{/Back}}{{^Front}}x{{/Front}}",
+              u"{{#Front}}{{#Tags}}{{Tags}}{{/Tags}}{{/Front}}",
+              u"{{#cq:1:Text}}q{{/cq:1:Text}}{{cq:1:Text}}{{ca:1:Text}}",
+              u"{{text:Front}} {{{Front}}} {{!comment}} {{type:Back}}",
+              u"{{Missing}} {{foo:Front}} {{Loop}} {{Open}}{{Front}}",
+              u"{{#Front}}x{{/Front}}{{/Front}}", u"{{#Front}}{{#Front}}x{{/Front}}",
+              u"{{=<% %>=}}<%Front%>", u"{{>partial}}", u"a{{#Front}}{b{{/Front}}{Front}}",
+              u"{{#Front}}}{{/Front}}", u"{{{Front}}}{{Front}}}"):
+        assert CompiledTemplate(t).render(ctx) == Template(t, ctx).render(), t
+    # compiled templates are reused until the model changes
+    deck = getEmptyDeck()
+    f = deck.newNote()
+    f['Front'] = u'1'; f['Back'] = u'2'
+    deck.addNote(f)
+    m = deck.models.current()
+    # stock templates don't need the fallback
+    assert CompiledTemplate(m['tmpls'][0]['afmt']).nodes
+    c = f.cards()[0]
+    assert c.q(reload=True).endswith("1")
+    assert len(deck.models._compiled) == 2
+    compiled = deck.models._compiled.values()
+    c.q(reload=True)
+    assert sorted(deck.models._compiled.values()) == sorted(compiled)
+    # editing the template without saving is picked up
+    m['tmpls'][0]['qfmt'] = "[{{Front}}]"
+    assert c.q(reload=True).endswith("[1]")
+    deck.models.save(m)
+    assert c.q(reload=True).endswith("[1]")
+
+def test_req():
+    d = getEmptyDeck()
+    mm = d.models
+    m = mm.current()
+    mm.addField(m, mm.newField("Extra"))
+    flds = mm.fieldNames(m)
+    t = m['tmpls'][0]
+    for fmt, req in (
+        ("{{Front}}", ('all', [0])),
+        ("{{Front}}{{Back}}", ('any', [0, 1])),
+        ("{{#Front}}{{Back}}{{/Front}}", ('all', [0, 1])),
+        ("{{^Back}}{{Front}}{{/Back}}{{Extra}}", ('all', [2])),
+        ("{{^Back}}{{Front}}{{/Back}}", ('none', [], [])),
+        ("{{text:Extra}} {{Tags}} {{Deck}}", ('all', [2])),
+        # a modified empty constant shows nothing
+        ("{{Front}}{{Back}}{{^Extra}}{{text:Tags}}{{/Extra}}",
+         ('any', [0, 1])),
+        ("{{Front}}{{Back}}{{^Extra}}{{hint:Tags}}{{/Extra}}",
+         ('any', [0, 1])),
+        ("{{#c1}}{{Back}}{{/c1}}{{#c2}}{{Front}}{{/c2}}", ('all', [1])),
+        ("{{Missing}}", ('none', [], [])),
+        ("{{#Front}}x{{/Front}}", ('all', [0, 1, 2]))):
+        t['qfmt'] = fmt
+        assert mm._reqForTemplate(m, flds, t) == req, fmt
+        assert mm._reqByRendering(m, flds, t) == req, fmt
+    # availability is checked against the saved requirements
+    mm.save(m)
+    assert m['req'] == [(0, 'all', [0, 1, 2])]
+    assert mm.availOrds(m, joinFields([u"1", u"", u"3"])) == []
+    assert mm.availOrds(m, joinFields([u"1", u"2", u"3"])) == [0]
@@ -674,6 +674,54 @@ def test_cram_rem():
     assert c.type == c.queue == 0
     assert c.due == oldDue
 
+def test_cram_incremental():
+    d = getEmptyDeck()
+    for i in range(4):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        f.tags = ["cram"]
+        d.addNote(f)
+    did = d.decks.newDyn("Cram")
+    deck = d.decks.get(did)
+    deck['terms'][0][0] = "tag:cram"
+    d.decks.save(deck)
+    cids = d.sched.rebuildDyn(did)
+    assert len(cids) == 4
+    # answer one, so it's in learning
+    d.reset()
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 2)
+    assert c.queue == 1
+    # one note leaves, and another is added
+    d.db.execute("update cards set mod = 0")
+    before = dict((r[0], r[1:]) for r in d.db.execute(
+        "select id, type, queue, due, odue, mod from cards"))
+    gone = d.getCard([x for x in cids if x != c.id][0]).note()
+    gone.tags = []
+    gone.flush()
+    d.db.execute("update cards set mod = 0 where nid = ?", gone.id)
+    f = d.newNote()
+    f['Front'] = u"new"
+    f.tags = ["cram"]
+    d.addNote(f)
+    new = f.cards()[0].id
+    ids = d.sched.rebuildDyn(did, incremental=True)
+    assert sorted(ids) == sorted([x for x in cids if x != gone.cards()[0].id]
+                                 + [new])
+    # remaining cards are untouched, including the learning card
+    rows = dict((r[0], r[1:]) for r in d.db.execute(
+        "select id, type, queue, due, odue, mod from cards"))
+    for id in cids:
+        if id != gone.cards()[0].id:
+            assert rows[id] == before[id]
+    # the leaving card is home, and the new card comes last
+    g = gone.cards()[0]
+    assert g.did == 1 and g.odid == 0 and g.mod
+    n = d.getCard(new)
+    assert n.did == did
+    assert n.due == max(rows[x][2] for x in cids
+                        if x != g.id and rows[x][1] == 0) + 1
+
 def test_cram_resched():
     # add card
     d = getEmptyDeck()
@@ -967,6 +1015,181 @@ def test_deckDue():
     d.sched.deckDueList()
     d.sched.deckDueTree()
 
+def test_deckDueQueries():
+    d = getEmptyDeck()
+    def dueQueries():
+        cnt = [0]
+        old = d.db.execute
+        def execute(*args, **kwargs):
+            cnt[0] += 1
+            return old(*args, **kwargs)
+        d.db.execute = execute
+        try:
+            d.sched.deckDueList()
+        finally:
+            d.db.execute = old
+        return cnt[0]
+    for i in range(5):
+        d.decks.id("foo::%d" % i)
+    few = dueQueries()
+    for i in range(50):
+        d.decks.id("bar::%d" % i)
+    # query count should not grow with the number of decks
+    assert dueQueries() == few
+
+def test_countCache():
+    d = getEmptyDeck()
+    other = d.decks.id("other")
+    for i in range(6):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    # make a few of them reviews
+    d.db.execute("update cards set type=2,queue=2,due=0,ivl=1,factor=2500 "
+                 "where id in (?,?)", cids[0], cids[1])
+    d.reset()
+    cache = d.sched._countCache
+    def check():
+        d.reset()
+        # should match a full recount
+        cnts = d.sched.counts()
+        d.sched._countCache = None
+        d.reset()
+        assert d.sched.counts() == cnts
+    # answering shouldn't trigger a recount
+    c = d.sched.getCard()
+    d.sched.answerCard(c, 3)
+    d.reset()
+    assert d.sched._countCache is cache
+    check()
+    d.sched.buryCards([cids[2]])
+    check()
+    d.sched.suspendCards([cids[3]])
+    check()
+    d.sched.forgetCards([cids[0], cids[1]])
+    check()
+    d.decks.setDeck([cids[4]], other)
+    check()
+    did = d.decks.newDyn("Cram")
+    d.sched.rebuildDyn(did)
+    check()
+    d.sched.rebuildDyn(did, incremental=True)
+    check()
+    d.sched.emptyDyn(did)
+    check()
+    # and modifications elsewhere should be noticed
+    d.decks.select(1)
+    d.reset()
+    cnts = d.sched.counts()
+    d.db.execute("update cards set queue=0 where queue = -1")
+    d.reset()
+    assert d.sched.counts()[0] == cnts[0] + 1
+
+def test_answerCards():
+    import random
+    def setup():
+        d = getEmptyDeck()
+        for i in range(4):
+            f = d.newNote()
+            f['Front'] = u"%d" % i
+            d.addNote(f)
+        cids = d.db.list("select id from cards order by id")
+        # half of them are reviews
+        d.db.execute("update cards set type=2,queue=2,due=0,ivl=10,"
+                     "factor=2500 where id in (?,?)", cids[0], cids[1])
+        d.reset()
+        return d, cids
+    # sequential
+    d, cids = setup()
+    random.seed(1)
+    for cid, ease in zip(cids, (3, 4, 1, 3)):
+        c = d.getCard(cid)
+        c.startTimer()
+        d.sched.answerCard(c, ease)
+    seq = d.db.all("select ivl, factor, queue, type, reps, left from cards "
+                   "order by id")
+    # batched
+    d, cids = setup()
+    random.seed(1)
+    now = time.time()
+    d.sched.answerCards([(cid, ease, 5000, now)
+                         for cid, ease in zip(cids, (3, 4, 1, 3))])
+    assert d.db.all("select ivl, factor, queue, type, reps, left from cards "
+                    "order by id") == seq
+    # learning card is due relative to the answer time
+    c = d.getCard(cids[2])
+    assert c.queue == 1
+    assert now + 60 <= c.due <= now + 60*1.25 + 1
+    # revlog entries have unique ids and the provided time
+    assert d.db.list("select time from revlog") == [5000]*4
+    assert d.db.scalar("select count(distinct id) from revlog") == 4
+    assert d.db.scalar("select min(id) from revlog") == int(now*1000)
+    # same card can be answered repeatedly
+    d.sched.answerCards([(cids[2], 2, 1000, now+60), (cids[2], 2, 1000, now+700)])
+    c.load()
+    assert c.queue == 2
+    assert d.db.scalar("select count() from revlog where cid = ?",
+                       cids[2]) == 3
+
+def test_prefetch():
+    d = getEmptyDeck()
+    for i in range(3):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    d.reset()
+    c = d.sched.getCard()
+    d.sched.prefetch()
+    assert len(d.sched._prefetched) == 2
+    d.sched.answerCard(c, 2)
+    # answering doesn't invalidate other notes' cards
+    c = d.sched.getCard()
+    assert c._qa
+    # but editing does
+    d.sched.prefetch()
+    n = d.getCard(d.sched._newQueue[-1]).note()
+    n['Front'] = u"changed"
+    n.flush()
+    c = d.sched.getCard()
+    assert c.q().endswith("changed")
+
+def test_simulatedForecast():
+    try:
+        from anki.simulate import Simulator
+        import numpy
+    except ImportError:
+        print "aborting test; numpy is not installed"
+        return
+    d = getEmptyDeck()
+    for i in range(30):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    # two due reviews, one scheduled in three days
+    cids = d.db.list("select id from cards order by id")
+    d.db.execute("update cards set type=2, queue=2, ivl=10, factor=2500, "
+                 "due=? where id in (?,?)", d.sched.today, cids[0], cids[1])
+    d.db.execute("update cards set type=2, queue=2, ivl=10, factor=2500, "
+                 "due=? where id = ?", d.sched.today+3, cids[2])
+    sim = Simulator(d)
+    res = sim.forecast(days=30, runs=5, seed=1)
+    assert len(res['reviews']) == 30
+    # 20 new cards a day by default
+    assert res['new'][:3] == [20, 7, 0]
+    # today's reviews plus new cards graduated with a one day interval
+    assert res['reviews'][0] == 2
+    assert res['reviews'][1] == 20
+    assert sum(res['reviews']) > 30
+    # review limits cap a day's workload
+    d.decks.confForDid(1)['rev']['perDay'] = 5
+    res = Simulator(d).forecast(days=30, runs=5, seed=1)
+    assert max(res['reviews']) == 5
+    # scheduler wrapper returns whole counts for the active decks
+    ret = d.sched.simulatedForecast(days=5, runs=2)
+    assert len(ret) == 5
+    assert ret[0] == 2
+
 def test_deckTree():
     d = getEmptyDeck()
     d.decks.id("new::b::c")
@@ -1068,6 +1291,33 @@ def test_resched():
     assert c.due == d.sched.today+1
     assert c.ivl == +1
 
+def test_bulkResched():
+    d = getEmptyDeck()
+    for i in range(25):
+        f = d.newNote()
+        f['Front'] = u"%d" % i
+        d.addNote(f)
+    cids = d.db.list("select id from cards order by id")
+    # force several chunks
+    d.sched.bulkChunk = 10
+    calls = []
+    d.sched.reschedCards(cids, 5, 10,
+                         progress=lambda done, total: calls.append(done))
+    assert calls == [10, 20, 25]
+    for due, ivl in d.db.execute("select due, ivl from cards"):
+        assert d.sched.today+5 <= due <= d.sched.today+10
+        assert ivl == due - d.sched.today
+    # forgetting puts them back in the provided order, across chunks
+    d.sched.forgetCards(list(reversed(cids)))
+    assert d.db.list("select id from cards order by due") == \
+        list(reversed(cids))
+    assert d.db.scalar("select count() from cards where queue != 0") == 0
+    # resetting only repositions cards that aren't new
+    d.sched.reschedCards(cids[:5], 1, 1)
+    d.sched.resetCards(cids)
+    assert d.db.list("select id from cards order by due") == \
+        list(reversed(cids[5:])) + cids[:5]
+
 def test_norelearn():
     d = getEmptyDeck()
     # add a note
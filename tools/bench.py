@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright: Damien Elmes <anki@ichi2.net>
+# License: GNU AGPL, version 3 or later; http://www.gnu.org/licenses/agpl.html
+#
+# Scheduler benchmarks on a synthetic collection.
+#
+# Usage:
+# tools/bench.py                      # default sized collection, JSON output
+# tools/bench.py --notes 50000 --decks 50 --depth 3
+# tools/bench.py --path /tmp/big.anki2  # generate once, then reuse
+#
+# Prints a JSON object with the collection's parameters and, for each
+# operation, the best and mean time in seconds over the repeats, the number
+# of SQL statements executed and the number of rows changed. The collection
+# is generated with a fixed seed, so results are comparable across versions.
+
+import os
+import sys
+import time
+import json
+import random
+import tempfile
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from anki import Collection
+from anki.lang import _
+
+# Generating
+######################################################################
+
+def generate(col, opts):
+    "Add decks, notes and review history to COL according to OPTS."
+    rnd = random.Random(opts.seed)
+    dids = makeDecks(col, opts.decks, opts.depth)
+    if opts.reverse:
+        m = col.models.byName(_("Basic (and reversed card)"))
+    else:
+        m = col.models.byName(_("Basic"))
+    col.models.setCurrent(m)
+    for i in range(opts.notes):
+        f = col.newNote()
+        f['Front'] = u"front %d" % i
+        f['Back'] = u"back %d" % i
+        f.tags = [u"tag%d" % (i % 10)]
+        f.model()['did'] = rnd.choice(dids)
+        col.addNote(f)
+    cids = col.db.list("select id from cards order by id")
+    studied = rnd.sample(cids, int(len(cids)*opts.studied))
+    # answer the studied cards a few times over the past year, oldest first
+    now = time.time()
+    answers = []
+    for cid in studied:
+        stamp = now - rnd.randint(1, 365)*86400
+        for n in range(opts.history):
+            stamp += rnd.randint(1, 30)*60
+            answers.append((cid, rnd.choice((1, 2, 3, 3, 3, 4)),
+                            rnd.randint(2000, 20000), stamp))
+    answers.sort(key=lambda a: a[3])
+    # siblings answered in the same batch can't be buried
+    conf = col.decks.confForDid(1)
+    bury = conf['new']['bury'], conf['rev']['bury']
+    conf['new']['bury'] = conf['rev']['bury'] = False
+    col.sched.answerCards(answers)
+    conf['new']['bury'], conf['rev']['bury'] = bury
+    col.decks.save(conf)
+    # then spread them around today, so some are overdue
+    col.sched.reschedCards(studied, -30, 90)
+    # the history shouldn't count towards today's limits
+    for g in col.decks.all():
+        for t in "new", "rev", "lrn", "time":
+            g[t+"Today"] = [col.sched.today, 0]
+        col.decks.save(g)
+    col.save()
+    return dict(decks=len(dids), notes=opts.notes, cards=len(cids),
+                studied=len(studied), revlog=len(answers))
+
+def makeDecks(col, count, depth):
+    "Create COUNT decks, nested up to DEPTH levels below the top level."
+    dids = []
+    parents = [""]
+    for i in range(count):
+        parent = parents[i % len(parents)]
+        name = "%sDeck %d" % (parent, i)
+        dids.append(col.decks.id(name))
+        if name.count("::") < depth:
+            parents.append(name + "::")
+    return dids
+
+# Measuring
+######################################################################
+
+class Counter(object):
+    "Counts statements executed through a collection's DB object."
+
+    def __init__(self, db):
+        self.db = db
+        self.statements = 0
+        for name in ("execute", "executemany", "executescript"):
+            setattr(db, name, self._wrap(getattr(db, name)))
+
+    def _wrap(self, fn):
+        def wrapper(*args, **kwargs):
+            self.statements += 1
+            return fn(*args, **kwargs)
+        return wrapper
+
+def measure(col, counter, fn, repeats, setup=None):
+    times = []
+    statements = []
+    changes = []
+    for i in range(repeats):
+        if setup:
+            setup()
+        s = counter.statements
+        c = col.db.totalChanges()
+        t = time.time()
+        fn()
+        times.append(time.time() - t)
+        statements.append(counter.statements - s)
+        changes.append(col.db.totalChanges() - c)
+    return dict(best=min(times), mean=sum(times)/len(times),
+                statements=max(statements), changes=max(changes))
+
+def benchmark(col, opts):
+    counter = Counter(col.db)
+    sched = col.sched
+    res = {}
+    col.decks.select(1)
+    res['reset'] = measure(col, counter, sched.reset, opts.repeats)
+    res['deckDueTree'] = measure(col, counter, sched.deckDueTree, opts.repeats)
+    # a study session in the top level deck
+    col.decks.select(col.decks.id("Deck 0"))
+    sched.reset()
+    answered = []
+    def study():
+        for i in range(opts.answers):
+            c = sched.getCard()
+            if not c:
+                break
+            sched.answerCard(c, 3)
+            answered.append(c.id)
+    res['getCard+answerCard'] = measure(col, counter, study, 1)
+    res['getCard+answerCard']['answers'] = len(answered)
+    # filtered decks
+    did = col.decks.newDyn("Bench")
+    deck = col.decks.get(did)
+    deck['terms'][0] = ["is:due", opts.dynLimit, 0]
+    col.decks.save(deck)
+    res['rebuildDyn'] = measure(
+        col, counter, lambda: sched.rebuildDyn(did), opts.repeats,
+        setup=lambda: sched.emptyDyn(did))
+    res['rebuildDyn(incremental)'] = measure(
+        col, counter, lambda: sched.rebuildDyn(did, incremental=True),
+        opts.repeats)
+    col.decks.rem(did)
+    # leave the collection as generated
+    col.rollback()
+    return res
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--path", help="collection to use; generated if "
+                      "missing, temporary if not provided")
+    parser.add_option("--decks", type="int", default=20)
+    parser.add_option("--depth", type="int", default=2,
+                      help="maximum nesting below top level decks")
+    parser.add_option("--notes", type="int", default=5000)
+    parser.add_option("--reverse", action="store_true",
+                      help="two cards per note")
+    parser.add_option("--studied", type="float", default=0.5,
+                      help="fraction of cards with review history")
+    parser.add_option("--history", type="int", default=5,
+                      help="answers per studied card")
+    parser.add_option("--seed", type="int", default=0)
+    parser.add_option("--repeats", type="int", default=5)
+    parser.add_option("--answers", type="int", default=100,
+                      help="cards answered in the study benchmark")
+    parser.add_option("--dyn-limit", dest="dynLimit", type="int",
+                      default=9999)
+    opts, args = parser.parse_args()
+    random.seed(opts.seed)
+    path = opts.path
+    temp = not path
+    if temp:
+        (fd, path) = tempfile.mkstemp(suffix=".anki2")
+        os.close(fd)
+        os.unlink(path)
+    new = not os.path.exists(path)
+    col = Collection(path)
+    try:
+        t = time.time()
+        if new:
+            info = generate(col, opts)
+            info['generated'] = time.time() - t
+        else:
+            info = dict(cards=col.cardCount(), notes=col.noteCount(),
+                        decks=len(col.decks.all()),
+                        revlog=col.db.scalar("select count() from revlog"))
+        info['results'] = benchmark(col, opts)
+    finally:
+        col.close(save=False)
+        if temp:
+            os.unlink(path)
+    print json.dumps(info, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    main()